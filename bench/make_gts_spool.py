@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+# build a synthetic GTS spool for benchmarking
+# run with "make_gts_spool.py outdir 2020030512 [hours] [files_per_hour] [seed]"
+#
+# The tree looks like the RMI GTS spool: hourly directories "YYYYMMDDHH" with
+# files named TTAAII_CCCC_YYGGgg[_BBB], each holding one GTS message (SOH ... ETX).
+# Every directory has a mix of
+#   - single subset land SYNOP bulletins (307080, uncompressed)
+#   - multi-subset land SYNOP bulletins, uncompressed and compressed
+#   - ship bulletins (308009)
+#   - corrections (CCA, CCB) of earlier bulletins, arriving later
+#   - duplicates (the same bulletin again, also in a later directory)
+#   - bulletins outside the default filter (other regions, TEMP, ...)
+#   - junk: empty files, files without GTS header, truncated BUFR
+from eccodes import *
+import datetime as dt
+import os
+import sys
+import random
+
+# ECMWF, BUFR edition 4, "surface data - land"
+land_template = [307080]
+ship_template = [308009]
+
+def bufr_set_subsets(bmsg, key, values, compressed) :
+  if compressed :
+    if isinstance(values[0], str) :
+      codes_set_string_array(bmsg, key, values)
+    else :
+      codes_set_array(bmsg, key, values)
+  else :
+    for i in range(len(values)) :
+      codes_set(bmsg, '#%d#%s' % (i+1, key), values[i])
+
+# stations: list of (station identifier, lat, lon, temperature)
+#   the identifier is (block, station) for land stations, a string for ships
+def make_bufr(obsdate, stations, compressed=False, ship=False) :
+  nsub = len(stations)
+  bmsg = codes_bufr_new_from_samples('BUFR4')
+  try :
+    codes_set(bmsg, 'bufrHeaderCentre', 98)
+    codes_set(bmsg, 'dataCategory', 1 if ship else 0)
+    codes_set(bmsg, 'internationalDataSubCategory', 0 if ship else 2)
+    codes_set(bmsg, 'typicalYear', obsdate.year)
+    codes_set(bmsg, 'typicalMonth', obsdate.month)
+    codes_set(bmsg, 'typicalDay', obsdate.day)
+    codes_set(bmsg, 'typicalHour', obsdate.hour)
+    codes_set(bmsg, 'typicalMinute', obsdate.minute)
+    codes_set(bmsg, 'numberOfSubsets', nsub)
+    codes_set(bmsg, 'observedData', 1)
+    codes_set(bmsg, 'compressedData', 1 if compressed else 0)
+    codes_set_array(bmsg, 'unexpandedDescriptors', ship_template if ship else land_template)
+
+    if ship :
+      bufr_set_subsets(bmsg, 'shipOrMobileLandStationIdentifier',
+                       [ x[0] for x in stations ], compressed)
+    else :
+      bufr_set_subsets(bmsg, 'blockNumber', [ x[0][0] for x in stations ], compressed)
+      bufr_set_subsets(bmsg, 'stationNumber', [ x[0][1] for x in stations ], compressed)
+    for (key, value) in [('year', obsdate.year), ('month', obsdate.month),
+                         ('day', obsdate.day), ('hour', obsdate.hour),
+                         ('minute', obsdate.minute)] :
+      bufr_set_subsets(bmsg, key, [value] * nsub, compressed)
+    bufr_set_subsets(bmsg, 'latitude', [ x[1] for x in stations ], compressed)
+    bufr_set_subsets(bmsg, 'longitude', [ x[2] for x in stations ], compressed)
+    bufr_set_subsets(bmsg, 'airTemperature', [ x[3] for x in stations ], compressed)
+    codes_set(bmsg, 'pack', 1)
+    result = codes_get_message(bmsg)
+  finally :
+    codes_release(bmsg)
+  return result
+
+def gts_message(heading, bufr, seq) :
+  return (b'\x01\r\r\n' + b'%03d' % (seq % 1000) + b'\r\r\n' + heading.encode() +
+          b'\r\r\n' + bufr + b'\r\r\n\x03')
+
+# TTAAII CCCC YYGGgg [BBB] -> file name
+def gts_filename(TTAAII, CCCC, obsdate, BBB=None) :
+  name = TTAAII + '_' + CCCC + '_' + obsdate.strftime('%d%H%M')
+  if BBB is not None :
+    name += '_' + BBB
+  return name
+
+def gts_heading(TTAAII, CCCC, obsdate, BBB=None) :
+  heading = TTAAII + ' ' + CCCC + ' ' + obsdate.strftime('%d%H%M')
+  if BBB is not None :
+    heading += ' ' + BBB
+  return heading
+
+def land_stations(rng, nsub) :
+  result = []
+  for i in range(nsub) :
+    result.append(((rng.randint(1, 17), rng.randint(1, 999)),
+                   round(rng.uniform(35, 70), 2), round(rng.uniform(-10, 30), 2),
+                   round(rng.uniform(260, 300), 1)))
+  return result
+
+def ship_stations(rng, nsub) :
+  result = []
+  for i in range(nsub) :
+    callsign = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for k in range(5))
+    result.append((callsign, round(rng.uniform(35, 70), 2), round(rng.uniform(-30, 10), 2),
+                   round(rng.uniform(270, 295), 1)))
+  return result
+
+# the spool starts at first_dir and covers the given number of hours
+# returns a dict with some statistics
+def make_spool(outdir, first_dir, hours=3, files_per_hour=300, seed=1) :
+  rng = random.Random(seed)
+  stats = {'files':0, 'bytes':0, 'subsets':0}
+  seq = 0
+  # bulletins that can be corrected or duplicated in a later directory
+  sent = []
+  centres = ['EBBR', 'EGRR', 'LFPW', 'EDZW', 'LIIB', 'ESWI', 'LEMM', 'EHDB']
+  for hour in range(hours) :
+    gtsdate = first_dir + dt.timedelta(hours=hour)
+    gtsdir = os.path.join(outdir, gtsdate.strftime('%Y%m%d%H'))
+    os.makedirs(gtsdir, exist_ok=True)
+    for k in range(files_per_hour) :
+      seq += 1
+      # the observations of a directory are mostly for the previous hour
+      obsdate = gtsdate - dt.timedelta(hours=rng.choice([0, 0, 1, 1, 1, 2]))
+      obsdate = obsdate.replace(minute=rng.choice([0, 0, 0, 30]))
+      CCCC = rng.choice(centres)
+      BBB = None
+      kind = rng.random()
+      if kind < 0.40 :
+        TTAAII = 'ISMN%02i' % rng.randint(1, 99)
+        bufr = make_bufr(obsdate, land_stations(rng, 1))
+        nsub = 1
+      elif kind < 0.55 :
+        nsub = rng.randint(2, 40)
+        TTAAII = 'ISND%02i' % rng.randint(1, 99)
+        bufr = make_bufr(obsdate, land_stations(rng, nsub))
+      elif kind < 0.70 :
+        nsub = rng.randint(2, 200)
+        TTAAII = 'ISNA%02i' % rng.randint(1, 99)
+        bufr = make_bufr(obsdate, land_stations(rng, nsub), compressed=True)
+      elif kind < 0.78 :
+        nsub = rng.randint(1, 20)
+        TTAAII = 'ISSD%02i' % rng.randint(1, 99)
+        bufr = make_bufr(obsdate, ship_stations(rng, nsub), ship=True)
+      elif kind < 0.86 and len(sent) > 0 :
+        # correction or duplicate of an earlier bulletin
+        (TTAAII, CCCC, obsdate, BBB0, bufr, nsub) = rng.choice(sent)
+        if rng.random() < 0.5 :
+          BBB = 'CCA' if BBB0 is None else 'CC' + chr(ord(BBB0[2]) + 1)
+        else :
+          BBB = BBB0
+      elif kind < 0.94 :
+        # outside the default filter: other region or not a SYNOP
+        nsub = 1
+        TTAAII = rng.choice(['ISMS', 'ISMA', 'IUSD', 'ISXN']) + '%02i' % rng.randint(1, 99)
+        bufr = make_bufr(obsdate, land_stations(rng, 1))
+      else :
+        # junk
+        nsub = 0
+        name = 'ISMN%02i_%s_%s_%i' % (rng.randint(1, 99), CCCC, obsdate.strftime('%d%H%M'), seq)
+        junk = rng.choice([b'', b'BUFR1234567',
+                           bytes(rng.getrandbits(8) for x in range(rng.randint(10, 500))),
+                           make_bufr(obsdate, land_stations(rng, 1))[:40]])
+        with open(os.path.join(gtsdir, name), 'wb') as f1 :
+          f1.write(junk)
+        stats['files'] += 1
+        stats['bytes'] += len(junk)
+        continue
+
+      name = gts_filename(TTAAII, CCCC, obsdate, BBB)
+      if os.path.exists(os.path.join(gtsdir, name)) :
+        # same heading in the same directory: arrives again with another name
+        name += '_%i' % seq
+      data = gts_message(gts_heading(TTAAII, CCCC, obsdate, BBB), bufr, seq)
+      with open(os.path.join(gtsdir, name), 'wb') as f1 :
+        f1.write(data)
+      if TTAAII[0:2] == 'IS' and TTAAII[3] in 'ADNX' :
+        sent.append((TTAAII, CCCC, obsdate, BBB, bufr, nsub))
+      stats['files'] += 1
+      stats['bytes'] += len(data)
+      stats['subsets'] += nsub
+  return stats
+
+if __name__ == '__main__' :
+  if len(sys.argv) < 3 :
+    print("usage: make_gts_spool.py outdir YYYYMMDDHH [hours] [files_per_hour] [seed]")
+  else :
+    outdir = sys.argv[1]
+    first_dir = dt.datetime.strptime(sys.argv[2], "%Y%m%d%H")
+    hours = 3
+    files_per_hour = 300
+    seed = 1
+    if len(sys.argv) > 3 :
+      hours = int(sys.argv[3])
+    if len(sys.argv) > 4 :
+      files_per_hour = int(sys.argv[4])
+    if len(sys.argv) > 5 :
+      seed = int(sys.argv[5])
+    stats = make_spool(outdir, first_dir, hours, files_per_hour, seed)
+    print('%i files, %i bytes, %i subsets' % (stats['files'], stats['bytes'], stats['subsets']))
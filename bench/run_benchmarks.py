@@ -0,0 +1,259 @@
+#! /usr/bin/env python3
+# benchmarks for the SYNOP extractor
+# run with "run_benchmarks.py [workdir] [workers] [results_file]"
+#
+# A synthetic GTS spool is created in workdir/GTS (see make_gts_spool.py) the
+# first time, and re-used afterwards, so results of different runs can be compared.
+# Every benchmark runs in a separate process, so the peak RSS is its own
+# (the sum over the process and its worker processes, see rss_sampler).
+# All results are appended to results_file (json, one line per benchmark) and
+# compared with the previous result of the same benchmark on the same spool.
+import sys
+import os
+import datetime as dt
+import json
+import time
+import shutil
+import subprocess
+import resource
+import threading
+import glob
+import contextlib
+import io
+import sqlite3
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'module'))
+import bufr_filter_gts.synop_extractor as synop
+import make_gts_spool
+
+# the spool: 3 hourly directories, the cycle is in the middle
+spool_first_dir = dt.datetime(2020, 3, 5, 12)
+spool_hours = 3
+spool_files_per_hour = 300
+spool_seed = 1
+spool_id = 'h%i_f%i_s%i' % (spool_hours, spool_files_per_hour, spool_seed)
+cycle_date = dt.datetime(2020, 3, 5, 13)
+
+# a result is flagged if it is more than 10% slower than the previous one
+regression_threshold = 1.10
+
+benchmark_list = ['parse_subsets', 'parse_subsets_light', 'parse_file',
+                  'update_sqlite', 'update_sqlite_workers', 'update_sqlite_cached',
+                  'update_sqlite_memory',
+                  'bufr_make_output', 'bufr_make_output_workers',
+                  'bufr_make_output_repack']
+
+def spool_files(GTS_path) :
+  result = []
+  for dirname in sorted(os.listdir(GTS_path)) :
+    for filename in sorted(os.listdir(os.path.join(GTS_path, dirname))) :
+      result.append(os.path.join(GTS_path, dirname, filename))
+  return result
+
+def make_spool(workdir) :
+  GTS_path = os.path.join(workdir, 'GTS')
+  if not os.path.exists(GTS_path) :
+    print('Creating synthetic GTS spool in ' + GTS_path)
+    stats = make_gts_spool.make_spool(GTS_path, spool_first_dir, spool_hours,
+                                      spool_files_per_hour, spool_seed)
+    print('%i files, %i bytes, %i subsets' % (stats['files'], stats['bytes'], stats['subsets']))
+  return GTS_path
+
+def count_obs(SQL_path) :
+  db = sqlite3.connect(synop.sqlite_filename(cycle_date, SQL_path))
+  result = db.execute('SELECT count(*) FROM obs').fetchone()[0]
+  db.close()
+  return result
+
+# an empty directory for the SQLite and BUFR files of 1 benchmark
+def clean_dir(path) :
+  shutil.rmtree(path, ignore_errors=True)
+  os.makedirs(path)
+  return path
+
+# the SQLite file that is used by the bufr_make_output benchmarks
+def prepare_output(workdir, GTS_path) :
+  SQL_path = os.path.join(workdir, 'sqlite')
+  if not os.path.exists(synop.sqlite_filename(cycle_date, SQL_path)) :
+    clean_dir(SQL_path)
+    with contextlib.redirect_stdout(io.StringIO()) :
+      synop.update_sqlite(cycle_date, SQL_path, GTS_path)
+  return SQL_path
+
+# run 1 benchmark
+# returns the number of files and subsets that were handled
+# (the preparation is done before the timer is started)
+def run_benchmark(name, workdir, GTS_path, workers, timer) :
+  (mindate, maxdate) = synop.obs_window(cycle_date, 30)
+  if name in ['parse_subsets', 'parse_subsets_light'] :
+    files = [ (filename, synop.read_gts_file(filename)) for filename in spool_files(GTS_path) ]
+    light = (name == 'parse_subsets_light')
+    timer.append(time.perf_counter())
+    nsub = 0
+    for (filename, data) in files :
+      batch = synop.parse_subsets(filename, data, light)
+      if batch is not None :
+        nsub += batch.subcount
+    return (len(files), nsub)
+
+  if name == 'parse_file' :
+    files = spool_files(GTS_path)
+    timer.append(time.perf_counter())
+    nsub = 0
+    for filename in files :
+      batch = synop.parse_file(filename, mindate, maxdate)
+      if batch is not None :
+        nsub += batch.subcount
+    return (len(files), nsub)
+
+  nfiles = len(spool_files(GTS_path))
+  if name in ['update_sqlite', 'update_sqlite_workers', 'update_sqlite_cached',
+              'update_sqlite_memory'] :
+    SQL_path = clean_dir(os.path.join(workdir, name))
+    parse_cache = None
+    nworkers = workers if name == 'update_sqlite_workers' else 1
+    if name == 'update_sqlite_cached' :
+      # fill the parse cache with another cycle data base
+      parse_cache = synop.parse_cache_filename(SQL_path)
+      synop.update_sqlite(cycle_date, clean_dir(os.path.join(workdir, name + '_first')),
+                          GTS_path, parse_cache=parse_cache)
+    timer.append(time.perf_counter())
+    index = 'memory' if name == 'update_sqlite_memory' else 'sqlite'
+    synop.update_sqlite(cycle_date, SQL_path, GTS_path, parse_cache=parse_cache,
+                        workers=nworkers, index=index)
+    return (nfiles, count_obs(SQL_path))
+
+  if name in ['bufr_make_output', 'bufr_make_output_workers', 'bufr_make_output_repack'] :
+    SQL_path = prepare_output(workdir, GTS_path)
+    BUFR_path = clean_dir(os.path.join(workdir, name))
+    nworkers = workers if name == 'bufr_make_output_workers' else 1
+    timer.append(time.perf_counter())
+    synop.bufr_make_output(cycle_date, SQL_path, BUFR_path, workers=nworkers,
+                           repack=(name == 'bufr_make_output_repack'))
+    return (nfiles, count_obs(SQL_path))
+
+  raise ValueError('unknown benchmark ' + name)
+
+# the memory (kB) of a process and all its descendants, from /proc (Linux)
+# (0 if not available)
+# PSS is used: the pages that the forked workers share with the parent are
+# then only counted once (RSS if the kernel has no smaps_rollup)
+def tree_rss_kb(pid) :
+  page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+  total = 0
+  todo = [pid]
+  while len(todo) > 0 :
+    pid = todo.pop()
+    try :
+      if os.path.exists('/proc/%i/smaps_rollup' % pid) :
+        with open('/proc/%i/smaps_rollup' % pid) as f1 :
+          total += sum([ int(line.split()[1]) for line in f1 if line.startswith('Pss:') ])
+      else :
+        with open('/proc/%i/statm' % pid) as f1 :
+          total += int(f1.read().split()[1]) * page_kb
+      for children in glob.glob('/proc/%i/task/*/children' % pid) :
+        with open(children) as f1 :
+          todo.extend([ int(x) for x in f1.read().split() ])
+    except (OSError, ValueError) :
+      # the process has just ended
+      continue
+  return total
+
+# The workers run at the same time, so the peak of the sum is needed:
+# ru_maxrss of RUSAGE_CHILDREN is only the largest single child process.
+# (a peak between 2 samples is missed)
+# The sum is sampled every 20 ms while the benchmark runs.
+def rss_sampler(state) :
+  while not state['stop'].wait(0.02) :
+    state['peak'] = max(state['peak'], tree_rss_kb(os.getpid()))
+
+# in the child process: run 1 benchmark and print the result (json)
+def run_single(name, workdir, workers) :
+  GTS_path = os.path.join(workdir, 'GTS')
+  timer = []
+  sampler = {'stop' : threading.Event(), 'peak' : tree_rss_kb(os.getpid())}
+  thread = threading.Thread(target=rss_sampler, args=(sampler,), daemon=True)
+  thread.start()
+  with contextlib.redirect_stdout(io.StringIO()) :
+    (nfiles, nsub) = run_benchmark(name, workdir, GTS_path, workers, timer)
+  seconds = time.perf_counter() - timer[0]
+  sampler['stop'].set()
+  thread.join()
+  # ru_maxrss is in kB on Linux (and the exact peak of this process alone)
+  rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, sampler['peak'])
+  print(json.dumps({'name':name, 'seconds':seconds, 'files':nfiles, 'subsets':nsub,
+                    'files_per_s':nfiles / seconds, 'subsets_per_s':nsub / seconds,
+                    'peak_rss_kb':rss}))
+
+def git_revision() :
+  try :
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=bench_dir,
+                            capture_output=True, text=True)
+  except OSError :
+    return None
+  if result.returncode != 0 :
+    return None
+  return result.stdout.strip()
+
+# the last stored result for every benchmark on this spool
+def previous_results(results_file) :
+  result = {}
+  if os.path.exists(results_file) :
+    with open(results_file) as f1 :
+      for line in f1 :
+        entry = json.loads(line)
+        if entry.get('spool') == spool_id :
+          result[(entry['name'], entry['workers'])] = entry
+  return result
+
+def run_all(workdir, workers, results_file) :
+  os.makedirs(workdir, exist_ok=True)
+  make_spool(workdir)
+  previous = previous_results(results_file)
+  revision = git_revision()
+  rundate = dt.datetime.today().strftime("%Y%m%d %H:%M:%S")
+  print('%-26s %8s %10s %12s %10s  %s' % ('benchmark', 'seconds', 'files/s', 'subsets/s',
+                                          'peak (MB)', 'previous'))
+  results = []
+  for name in benchmark_list :
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', name,
+                           workdir, str(workers)], capture_output=True, text=True)
+    if proc.returncode != 0 :
+      print('%-26s FAILED' % name)
+      sys.stderr.write(proc.stderr)
+      continue
+    entry = json.loads(proc.stdout.strip().splitlines()[-1])
+    entry.update({'date':rundate, 'revision':revision, 'workers':workers, 'spool':spool_id})
+    results.append(entry)
+
+    comparison = ''
+    old = previous.get((name, workers))
+    if old is not None :
+      ratio = entry['seconds'] / old['seconds']
+      comparison = '%+.0f%% (%s)' % ((ratio - 1) * 100, old['revision'])
+      if ratio > regression_threshold :
+        comparison += ' SLOWER'
+    print('%-26s %8.2f %10.1f %12.1f %10.1f  %s' %
+          (name, entry['seconds'], entry['files_per_s'], entry['subsets_per_s'],
+           entry['peak_rss_kb'] / 1024., comparison))
+
+  with open(results_file, 'a') as f1 :
+    for entry in results :
+      f1.write(json.dumps(entry) + '\n')
+  print('Results appended to ' + results_file)
+
+if __name__ == '__main__' :
+  if len(sys.argv) > 1 and sys.argv[1] == '--single' :
+    run_single(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+  else :
+    workdir = 'bench_work'
+    workers = 4
+    results_file = os.path.join(bench_dir, 'results.jsonl')
+    if len(sys.argv) > 1 :
+      workdir = sys.argv[1]
+    if len(sys.argv) > 2 :
+      workers = int(sys.argv[2])
+    if len(sys.argv) > 3 :
+      results_file = sys.argv[3]
+    run_all(workdir, workers, results_file)
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+# consistency checks for the SYNOP extractor
+# run with "run_checks.py [workdir]"
+#
+# Every check prints OK or FAILED (with the reason), the exit code is the
+# number of failed checks. The GTS files are made with make_gts_spool.py.
+import sys
+import os
+import datetime as dt
+import shutil
+import contextlib
+import io
+import sqlite3
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'module'))
+import bufr_filter_gts.synop_extractor as synop
+import make_gts_spool
+
+cycle_date = dt.datetime(2020, 3, 5, 13)
+
+# an empty directory for 1 check
+def clean_dir(path) :
+  shutil.rmtree(path, ignore_errors=True)
+  os.makedirs(path)
+  return path
+
+# a valid GTS file whose name looks like TTAAII_CCCC_YYGGgg, but with a
+# non-numeric day: the file name is no GTS header, the decoded one is used
+def check_filename_not_numeric(workdir) :
+  GTS_path = clean_dir(os.path.join(workdir, 'GTS'))
+  SQL_path = clean_dir(os.path.join(workdir, 'sqlite'))
+  gtsdir = os.path.join(GTS_path, cycle_date.strftime('%Y%m%d%H'))
+  os.makedirs(gtsdir)
+  bufr = make_gts_spool.make_bufr(cycle_date, [((6, 447), 50.8, 4.35, 280.)])
+  heading = make_gts_spool.gts_heading('ISMN01', 'EBBR', cycle_date)
+  with open(os.path.join(gtsdir, 'ISMN01_EBBR_xx1300'), 'wb') as f1 :
+    f1.write(make_gts_spool.gts_message(heading, bufr, 1))
+  with contextlib.redirect_stdout(io.StringIO()) :
+    synop.update_sqlite(cycle_date, SQL_path, GTS_path)
+  db = sqlite3.connect(synop.sqlite_filename(cycle_date, SQL_path))
+  result = db.execute('SELECT SID FROM data').fetchall()
+  db.close()
+  if result != [('06447',)] :
+    return 'expected station 06447, found %s' % result
+  return None
+
+# all BBB values of the checks below: NNN, corrections, delayed (RR),
+# amendments (AA) and a few odd values (from file names or ecCodes)
+bbb_values = ['NNN'] + [ prefix + chr(ord('A') + i) for prefix in ['CC', 'RR', 'AA']
+                         for i in range(26) ] + ['PAA', 'PZZ', 'CC1', 'CCa', 'CC', 'RR1', 'XYZ']
+
+# the BBB is stored as an integer (bbb_encode), it must come back unchanged,
+# in python and in the data view
+def check_bbb_roundtrip(workdir) :
+  for BBB in bbb_values :
+    if synop.bbb_decode(synop.bbb_encode(BBB)) != BBB :
+      return '%s is decoded as %s' % (BBB, synop.bbb_decode(synop.bbb_encode(BBB)))
+  db = sqlite3.connect(':memory:')
+  synop.create_obs_tables(db)
+  observations = [ ('IS', 'MN', '01', 'EBBR', '20200305-130000', BBB, '%05i' % i,
+                    'file', 0, 1, 0, 100) for (i, BBB) in enumerate(bbb_values) ]
+  db.executemany(synop.upsert_obs, synop.sqlite_obs_rows(db, observations))
+  result = dict(db.execute('SELECT SID, BBB FROM data'))
+  for (i, BBB) in enumerate(bbb_values) :
+    if result['%05i' % i] != BBB :
+      return '%s is %s in the data view' % (BBB, result['%05i' % i])
+  return None
+
+# for every pair of BBB values: the upsert into the obs table keeps the same
+# observation as gts_priority() (used by the memory index and the streaming)
+def check_bbb_priority(workdir) :
+  db = sqlite3.connect(':memory:')
+  synop.create_obs_tables(db)
+  pairs = [ (old, new) for old in bbb_values for new in bbb_values ]
+  for (filename, k) in [('old', 0), ('new', 1)] :
+    observations = [ ('IS', 'MN', '01', 'EBBR', '20200305-130000', pair[k], '%05i' % i,
+                      filename, 0, 1, 0, 100) for (i, pair) in enumerate(pairs) ]
+    db.executemany(synop.upsert_obs, synop.sqlite_obs_rows(db, observations))
+  result = dict(db.execute('SELECT SID, filename FROM data'))
+  wrong = []
+  for (i, (old, new)) in enumerate(pairs) :
+    expected = 'old' if synop.gts_priority(old, new) else 'new'
+    if result['%05i' % i] != expected :
+      wrong.append('%s->%s' % (old, new))
+  if len(wrong) > 0 :
+    return '%i pairs differ, e.g. %s' % (len(wrong), ' '.join(wrong[:5]))
+  return None
+
+check_list = [check_filename_not_numeric, check_bbb_roundtrip, check_bbb_priority]
+
+def run_all(workdir) :
+  failed = 0
+  for check in check_list :
+    try :
+      reason = check(clean_dir(os.path.join(workdir, check.__name__)))
+    except Exception as err :
+      reason = 'exception %r' % err
+    if reason is None :
+      print('%-36s OK' % check.__name__)
+    else :
+      print('%-36s FAILED: %s' % (check.__name__, reason))
+      failed += 1
+  return failed
+
+if __name__ == '__main__' :
+  workdir = 'check_work'
+  if len(sys.argv) > 1 :
+    workdir = sys.argv[1]
+  sys.exit(run_all(workdir))
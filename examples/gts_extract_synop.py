@@ -1,5 +1,5 @@
 #! /usr/bin/env python3
-# run with "gts_extract_bufr.py 2018040318 [GTS_path] [SQL_path] > 2018040318.log & "
+# run with "gts_extract_bufr.py 2018040318 [GTS_path] [SQL_path] [workers] > 2018040318.log & "
 #import bufr_filter_gts.synop_extractor as synop
 import synop_extractor as synop
 import sys
@@ -8,6 +8,7 @@ import datetime as dt
 GTS_path = "GTS"
 SQL_path = "."
 BUFR_path = "."
+workers = 1
 
 if len(sys.argv) < 2 :
   print("ERROR: YYYYMMDDHH must be provided!")
@@ -16,12 +17,17 @@ else :
     GTS_path = str(sys.argv[2])
   if len(sys.argv) > 3 :
     SQL_path = str(sys.argv[3])
+  if len(sys.argv) > 4 :
+    workers = int(sys.argv[4])
 
   datestr = str(sys.argv[1])
   print('Date string: ' + datestr)
   mydate = dt.datetime.strptime(datestr, "%Y%m%d%H")
 
-  synop.update_sqlite(mydate, SQL_path, GTS_path, obs_window_size=60)
-  synop.bufr_make_output(mydate, SQL_path, BUFR_path)
+  # the parse cache is shared by all cycles in SQL_path
+  synop.update_sqlite(mydate, SQL_path, GTS_path, obs_window_size=60,
+                      parse_cache=synop.parse_cache_filename(SQL_path),
+                      workers=workers)
+  synop.bufr_make_output(mydate, SQL_path, BUFR_path, workers=workers)
 
 
@@ -0,0 +1,26 @@
+#! /usr/bin/env python3
+# run with "gts_monitor_daemon.py [GTS_path] [SQL_path] [BUFR_path] [workers] > gts_monitor.log & "
+# stop with SIGTERM (kill) or Ctrl-C, a restart continues where it stopped
+#import bufr_filter_gts.synop_extractor as synop
+import synop_extractor as synop
+import sys
+
+GTS_path = "GTS"
+SQL_path = "."
+BUFR_path = "."
+workers = 1
+
+if len(sys.argv) > 1 :
+  GTS_path = str(sys.argv[1])
+if len(sys.argv) > 2 :
+  SQL_path = str(sys.argv[2])
+if len(sys.argv) > 3 :
+  BUFR_path = str(sys.argv[3])
+if len(sys.argv) > 4 :
+  workers = int(sys.argv[4])
+
+# hourly cycles, BUFR output 20' after the cycle time and an update after 3h
+synop.gts_monitor(SQL_path, GTS_path, BUFR_path, cycle_step=1, obs_window_size=60,
+                  cutoffs=[20, 180],
+                  parse_cache=synop.parse_cache_filename(SQL_path),
+                  workers=workers)
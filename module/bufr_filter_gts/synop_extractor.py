@@ -5,11 +5,30 @@
 ## Alex Deckmyn, 2018
 ## 2019-11-08 ported to python3
 
-#import numpy
+import numpy as np
 from eccodes import *
 import datetime as dt
 import os
+import sys
 import sqlite3
+import json
+import hashlib
+import itertools
+import multiprocessing
+import re
+import ctypes
+import ctypes.util
+import select
+import signal
+import time
+import tarfile
+import zipfile
+import tempfile
+import atexit
+import shutil
+import gzip
+import bz2
+import lzma
 
 # time window: e.g. 19:30 -- 20:29
 def obs_window(cycledate, nmin=30) :
@@ -30,44 +49,461 @@ def print_debug(*args) :
 #  print_dedug_on = bool(os.environ.get('BUFR_EXTRACTOR_DEBUG'))
   if print_debug_on :
     print(*args)
+
+##################
+# metrics: counters and timers per stage
+# Disabled (None) by default, then every call costs just 1 test.
+# metrics_enable() starts collecting, metrics_write() writes them as json and as
+# a Prometheus textfile (for the node exporter textfile collector).
+#   counters : e.g. files_listed, subsets_added
+#   rejected : number of rejected files per reason
+#   timers : seconds spent per stage (decode, sqlite, io, index),
+#            summed over all worker processes
+metrics = None
+
+def metrics_enable() :
+  global metrics
+  metrics = {'counters' : {}, 'rejected' : {}, 'timers' : {}}
+
+def metrics_disable() :
+  global metrics
+  metrics = None
+
+def metrics_count(name, n=1) :
+  if metrics is not None :
+    metrics['counters'][name] = metrics['counters'].get(name, 0) + n
+
+def metrics_reject(reason) :
+  if metrics is not None :
+    reason = reject_reasons.get(reason, reason)
+    metrics['rejected'][reason] = metrics['rejected'].get(reason, 0) + 1
+
+# t0 = metrics_start() ... metrics_stop('decode', t0)
+def metrics_start() :
+  if metrics is None :
+    return None
+  return time.perf_counter()
+
+def metrics_stop(name, t0) :
+  if t0 is not None :
+    metrics['timers'][name] = metrics['timers'].get(name, 0.) + time.perf_counter() - t0
+
+# add the metrics of a worker process
+def metrics_merge(other) :
+  if metrics is None or other is None :
+    return
+  for part in ['counters', 'rejected', 'timers'] :
+    for name in other[part] :
+      metrics[part][name] = metrics[part].get(name, 0) + other[part][name]
+
+# run: name of the run (e.g. update_sqlite), used as a label
+# writes filename + '.json' and filename + '.prom'
+def metrics_write(filename, run) :
+  if metrics is None :
+    return
+  result = dict(metrics, run=run, time=int(time.time()))
+  lines = []
+  for name in sorted(metrics['counters']) :
+    lines.append('# TYPE synop_extractor_%s_total counter' % name)
+    lines.append('synop_extractor_%s_total{run="%s"} %i' % (name, run, metrics['counters'][name]))
+  lines.append('# TYPE synop_extractor_rejected_total counter')
+  for reason in sorted(metrics['rejected']) :
+    lines.append('synop_extractor_rejected_total{run="%s",reason="%s"} %i'
+                 % (run, reason, metrics['rejected'][reason]))
+  lines.append('# TYPE synop_extractor_seconds_total counter')
+  for name in sorted(metrics['timers']) :
+    lines.append('synop_extractor_seconds_total{run="%s",stage="%s"} %.6f'
+                 % (run, name, metrics['timers'][name]))
+  lines.append('# TYPE synop_extractor_last_run_timestamp_seconds gauge')
+  lines.append('synop_extractor_last_run_timestamp_seconds{run="%s"} %i' % (run, result['time']))
+  # the textfile collector must never see a half-written file
+  for (ext, text) in [('.json', json.dumps(result, indent=1)), ('.prom', '\n'.join(lines))] :
+    tmpfile = filename + ext + '.tmp%i' % os.getpid()
+    f1 = open(tmpfile, 'w')
+    f1.write(text + '\n')
+    f1.close()
+    os.replace(tmpfile, filename + ext)
+
 ##################
 
+# The GTS filter is a first selection based simply on the GTS headers.
+# For every tag, give a list of allowed values ('?' matches any character),
+# or None to allow everything.
+# filename: if True, the header derived from the file name is trusted for
+#   rejecting files before they are even opened.
+# default: only BUFR-SYNOP (TT=IS), northern hemisphere, Europe... (AA[1] in A, D, N, X)
+#  (not: AA[1] in ['B', 'C', 'E', 'F', 'G', 'H','I', 'J', 'K', 'L', 'S', 'T'])
+gts_filter_spec = { 'TT' : ['IS'], 'AA' : ['?A', '?D', '?N', '?X'],
+                    'II' : None, 'CCCC' : None, 'filename' : True }
+
+# turn a filter spec into a single regular expression for "TTAAIICCCC"
+def compile_gts_filter(spec=gts_filter_spec) :
+  pattern = ''
+  for (key, size) in [('TT', 2), ('AA', 2), ('II', 2), ('CCCC', 4)] :
+    allowed = spec.get(key)
+    if allowed is None :
+      pattern += '.{%d}' % size
+    else :
+      pattern += '(?:' + '|'.join(re.escape(x).replace('\\?', '.') for x in allowed) + ')'
+  return {'heading' : re.compile(pattern), 'filename' : spec.get('filename', True)}
+
+gts_filter_default = compile_gts_filter(gts_filter_spec)
+
 # return TRUE if the header is useful
-def gts_filter(gtsheader) :
-  # only BUFR-SYNOP
-  if gtsheader['TT'] != 'IS' :
-    return False
-  # only northern hemisphere, Europe...
-  if not gtsheader['AA'][1] in ['A', 'D', 'N', 'X']:
-    return False
-#  if gtsheaders['AA'][1] in ['B', 'C', 'E', 'F', 'G', 'H','I', 'J', 'K', 'L', 'S', 'T']:
-#    return False
+def gts_filter(gtsheader, gfilter=None) :
+  if gfilter is None :
+    gfilter = gts_filter_default
+  heading = gtsheader['TT'] + gtsheader['AA'] + gtsheader['II'] + gtsheader['CCCC']
+  return gfilter['heading'].fullmatch(heading) is not None
+
+# check a GTS header against filter and time window
+# return None if the header is OK, or else the reason for rejecting it
+# (see reject_reasons for the names used in the metrics)
+reject_reasons = {'Not in Europe' : 'filtered',
+                  'No valid date retrieved.' : 'bad_date',
+                  'Not in time window' : 'outside_window'}
+def gts_check(gtsheader, mindate, maxdate, gfilter=None) :
+  if not gts_filter(gtsheader, gfilter) :
+    return 'Not in Europe'
+  gdt = gts_date(gtsheader, maxdate)
+  if gdt is None :
+    return 'No valid date retrieved.'
+  if gdt < mindate or gdt > maxdate :
+    return 'Not in time window'
+  return None
+
+# read the whole GTS file in one go
+# all decoding (GTS header, BUFR messages) is done on these bytes in memory
+# (also for a file in an archive, see archive_open)
+def read_gts_file(filename) :
+  (archive, member) = split_archive_name(filename)
+  if member is not None :
+    return archive_read(archive, member)
+  f1 = open(filename, 'rb')
+  data = f1.read()
+  f1.close()
+  return data
 
-  return True
+##########################################################
+# archived GTS directories
+# After a few hours, an hourly directory YYYYMMDDHH may be replaced by an
+# archive YYYYMMDDHH.tar (or .tar.gz, .tgz, .tar.bz2, .tar.xz, .zip).
+# The files are then read from the archive, the members are not unpacked to disk
+# (a compressed tar file is decompressed once, see archive_unpack).
+# A file in an archive is named "archive::member" (also in the data table),
+# so bufr_extract() etc. can read it directly.
+gts_archive_suffixes = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.zip')
+gts_archive_separator = '::'
+
+# returns (archive, member), or (filename, None) for a normal file
+def split_archive_name(fullname) :
+  pos = fullname.find(gts_archive_separator)
+  if pos < 0 :
+    return (fullname, None)
+  return (fullname[:pos], fullname[pos+len(gts_archive_separator):])
+
+def is_gts_archive(path) :
+  return path.endswith(gts_archive_suffixes) and not os.path.isdir(path)
+
+# the hourly directory, or its archive if the directory does not exist
+def gts_dir_path(GTS_path, dirname) :
+  gtsdir = os.path.join(GTS_path, dirname)
+  if not os.path.exists(gtsdir) :
+    for suffix in gts_archive_suffixes :
+      if os.path.exists(gtsdir + suffix) :
+        return gtsdir + suffix
+  return gtsdir
+
+# the full name of a file in a GTS directory (or archive)
+def gts_file_path(gtsdir, filename) :
+  if is_gts_archive(gtsdir) :
+    return gtsdir + gts_archive_separator + filename
+  return os.path.join(gtsdir, filename)
+
+# a file that was indexed before its hourly directory was archived:
+# GTS/YYYYMMDDHH/file is then read as GTS/YYYYMMDDHH.tar::file
+def gts_resolve_file(filename) :
+  if split_archive_name(filename)[1] is not None or os.path.exists(filename) :
+    return filename
+  (gtsdir, member) = os.path.split(filename)
+  archive = gts_dir_path(*os.path.split(gtsdir))
+  if is_gts_archive(archive) :
+    return gts_file_path(archive, member)
+  return filename
+
+def gts_file_exists(filename) :
+  (archive, member) = split_archive_name(filename)
+  if member is not None :
+    return os.path.exists(archive) and member in archive_open(archive)['members']
+  return os.path.exists(filename)
+
+def gts_file_size(filename) :
+  (archive, member) = split_archive_name(filename)
+  if member is not None :
+    return archive_open(archive)['members'][member][0]
+  return os.path.getsize(filename)
+
+# random access to the files in an archive
+# tar: every member is read with pread() at its position in the tar file
+#   a compressed tar file is first decompressed in one pass to a temporary
+#   file (in TMPDIR), because seeking in a compressed stream means
+#   decompressing it again from the start (see archive_unpack)
+# zip: zipfile
+# Only the last archive is kept open (per process).
+# members: {name : (size, mtime in ns, position in the tar file or name in the zip file)}
+# the names are as in the directory: "./file" or "YYYYMMDDHH/file" (e.g. from
+# "tar cf YYYYMMDDHH.tar YYYYMMDDHH") is just "file"
+archive_current = None
+# the decompressed tar files made by this program: {path : pid of the maker}
+archive_unpacked = {}
+
+# The decompressed tar file has a fixed name (from the archive path and
+# signature), so it is made only once and shared by the worker processes:
+# the parent opens an archive (listing, or archive_prepare) before the
+# workers read from it. Only the process that made the file removes it
+# (see archive_close), a worker that still has it open can go on reading.
+def archive_unpack(archive, signature) :
+  key = repr((os.path.abspath(archive), signature)).encode()
+  path = os.path.join(tempfile.gettempdir(),
+                      'gts_archive_' + hashlib.blake2b(key, digest_size=16).hexdigest() + '.tar')
+  if os.path.exists(path) :
+    return path
+  if archive.endswith('.tar.bz2') :
+    source = bz2.open(archive, 'rb')
+  elif archive.endswith('.tar.xz') :
+    source = lzma.open(archive, 'rb')
+  else :
+    source = gzip.open(archive, 'rb')
+  # written under a temporary name, so a file with the final name is complete
+  partial = path + '.%i' % os.getpid()
+  with source, open(partial, 'wb') as fobj :
+    shutil.copyfileobj(source, fobj, 1 << 20)
+  os.replace(partial, path)
+  archive_unpacked[path] = os.getpid()
+  return path
+
+def archive_compressed(archive) :
+  return is_gts_archive(archive) and not archive.endswith(('.tar', '.zip'))
+
+# decompress the archives of a list of files before worker processes read them
+def archive_prepare(filenames) :
+  archives = set( split_archive_name(gts_resolve_file(filename))[0] for filename in filenames )
+  for archive in sorted(archives) :
+    if archive_compressed(archive) and os.path.exists(archive) :
+      archive_unpack(archive, file_signature(archive))
+
+def archive_member_name(archive, name) :
+  stem = os.path.basename(archive)
+  for suffix in gts_archive_suffixes :
+    if stem.endswith(suffix) :
+      stem = stem[:-len(suffix)]
+      break
+  for prefix in ['./', stem + '/'] :
+    if name.startswith(prefix) :
+      name = name[len(prefix):]
+  return name
+
+def archive_open(archive) :
+  global archive_current
+  signature = file_signature(archive)
+  reader = archive_current
+  if reader is not None and reader['path'] == archive and reader['signature'] == signature \
+      and reader['pid'] == os.getpid() :
+    return reader
+  archive_close()
+  t0 = metrics_start()
+  reader = {'path' : archive, 'signature' : signature, 'pid' : os.getpid(),
+            'members' : {}, 'zip' : None, 'tar' : None}
+  if archive.endswith('.zip') :
+    reader['zip'] = zipfile.ZipFile(archive)
+    for info in reader['zip'].infolist() :
+      if not info.is_dir() :
+        mtime = int(dt.datetime(*info.date_time).timestamp() * 1e9)
+        reader['members'][archive_member_name(archive, info.filename)] = \
+          (info.file_size, mtime, info.filename)
+  else :
+    if archive.endswith('.tar') :
+      fobj = open(archive, 'rb')
+    else :
+      fobj = open(archive_unpack(archive, signature), 'rb')
+    reader['tar'] = fobj
+    with tarfile.open(fileobj=fobj, mode='r:') as tf :
+      for info in tf :
+        if info.isfile() :
+          reader['members'][archive_member_name(archive, info.name)] = \
+            (info.size, int(info.mtime * 1e9), info.offset_data)
+  metrics_stop('io', t0)
+  archive_current = reader
+  return reader
+
+def archive_close() :
+  global archive_current
+  if archive_current is not None and archive_current['pid'] == os.getpid() :
+    if archive_current['zip'] is not None :
+      archive_current['zip'].close()
+    if archive_current['tar'] is not None :
+      archive_current['tar'].close()
+  archive_current = None
+  archive_remove_unpacked()
+
+# the decompressed tar files made by this process
+# (also at exit, e.g. after bufr_extract() from an archive)
+def archive_remove_unpacked() :
+  for path in list(archive_unpacked) :
+    if archive_unpacked[path] == os.getpid() :
+      del archive_unpacked[path]
+      try :
+        os.remove(path)
+      except OSError :
+        pass
+
+atexit.register(archive_remove_unpacked)
+
+def archive_read(archive, member) :
+  reader = archive_open(archive)
+  (size, mtime, position) = reader['members'][member]
+  if reader['zip'] is not None :
+    return reader['zip'].read(position)
+  return os.pread(reader['tar'].fileno(), size, position)
+
+# the files in an archive, as gts_dir_listing()
+def archive_listing(archive) :
+  members = archive_open(archive)['members']
+  result = [ (name, members[name][0:2]) for name in members ]
+  result.sort()
+  return result
 
+# the abbreviated heading is always in the first few bytes:
+# SOH CR CR LF [nnn CR CR LF] TTAAii CCCC YYGGgg [BBB] CR CR LF
+gts_heading_size = 64
+gts_heading_regex = re.compile(rb'(?:\x01\r\r\n(?:[0-9]{3,5}\r\r\n)?)?'
+                               rb'([A-Z]{2})([A-Z]{2})([0-9]{2}) ([A-Z]{4}) '
+                               rb'([0-9]{2})([0-9]{2})([0-9]{2})(?: ([A-Z]{3}))?\r\r\n')
+
+# raw GTS header from the first bytes of the file, without ecCodes
+# (only used for quick rejection)
+def gts_from_heading(data) :
+  match = gts_heading_regex.search(data[0:gts_heading_size])
+  if match is None :
+    return None
+  tags = [ x.decode() if x is not None else 'NNN' for x in match.groups() ]
+  gtsheader = dict(zip(["TT","AA","II","CCCC","YY","GG","gg","BBB"], tags))
+  return gtsheader
 
-def get_gts_headers(filename) :
+# find the GTS message: SOH CR CR LF ... CR CR LF ETX
+# returns (offset, length) or None
+def gts_message_position(data) :
+  start = data.find(b'\x01\r\r\n')
+  if start < 0 :
+    return None
+  end = data.find(b'\r\r\n\x03', start)
+  if end < 0 :
+    return None
+  return (start, end + 4 - start)
+
+# bundled GTS files: many bulletins in one file
+# - WMO FTP format: every bulletin is preceded by its length (8 digits) and a
+#   format identifier (2 digits, 00: with SOH/ETX, 01: without)
+# - or just bulletins SOH ... ETX one after the other
+# the file is walked only once, a BUFR message inside a bulletin is skipped
+# using its length (the binary data may contain CR CR LF ETX)
+# a truncated bulletin at the end is left out
+# returns a list of (offset, length, raw GTS header or None)
+# a file without any of this framing is 1 bulletin: the whole file
+def gts_bulletin_index(data) :
+  result = []
+  size = len(data)
+  pos = 0
+  if data[0:10].isdigit() :
+    while pos + 10 <= size and data[pos:pos+10].isdigit() :
+      length = int(data[pos:pos+8])
+      start = pos + 10
+      if length == 0 or start + length > size :
+        print_debug('... truncated bulletin at %i' % pos)
+        break
+      result.append((start, length, gts_from_heading(data[start:start+gts_heading_size])))
+      pos = start + length
+  else :
+    while True :
+      start = data.find(b'\x01\r\r\n', pos)
+      if start < 0 :
+        break
+      pos = start + 4
+      end = data.find(b'\r\r\n\x03', pos)
+      bufr = data.find(b'BUFR', pos)
+      while end >= 0 and bufr >= 0 and bufr < end :
+        # only a valid BUFR message (see bufr_message_list) is skipped as a whole
+        length = int.from_bytes(data[bufr+4:bufr+7], 'big')
+        if length >= 8 and data[bufr+length-4:bufr+length] == b'7777' :
+          pos = bufr + length
+        else :
+          pos = bufr + 4
+        end = data.find(b'\r\r\n\x03', pos)
+        bufr = data.find(b'BUFR', pos)
+      if end < 0 :
+        print_debug('... truncated bulletin at %i' % start)
+        break
+      pos = end + 4
+      result.append((start, pos - start, gts_from_heading(data[start:start+gts_heading_size])))
+  if len(result) == 0 :
+    result.append((0, size, gts_from_heading(data)))
+  return result
+
+# quick test on the first bytes of a file (see gts_heading_size)
+# returns True if the file can not hold more than 1 bulletin
+# (the BUFR length is then known from section 0)
+def gts_single_bulletin(head, size) :
+  if head[0:10].isdigit() :
+    return False
+  pos = head.find(b'BUFR')
+  if pos < 0 or pos + 7 > len(head) :
+    return False
+  length = int.from_bytes(head[pos+4:pos+7], 'big')
+  # CR CR LF ETX, and some trailing bytes
+  return size <= pos + length + 16
+
+# find all BUFR messages: list of (offset, length)
+# (this replaces codes_count_in_file(), so we don't read the file twice)
+def bufr_message_list(data) :
+  result = []
+  pos = data.find(b'BUFR')
+  while pos >= 0 :
+    # section 0: 'BUFR', total length (3 bytes), edition number
+    length = int.from_bytes(data[pos+4:pos+7], 'big')
+    if length >= 8 and pos + length <= len(data) and data[pos+length-4:pos+length] == b'7777' :
+      result.append((pos, length))
+      pos = data.find(b'BUFR', pos + length)
+    else :
+      pos = data.find(b'BUFR', pos + 4)
+  return result
+
+def get_gts_headers(filename, data=None) :
 ## there is always only 1 GTS message in a file (you could get header from filename, too)
 ## we also count the number of BUFR messages
   keylist=["TT","AA","II","CCCC","YY","GG","gg","BBB"]
-  f1 = open(filename)
+  if data is None :
+    data = read_gts_file(filename)
 
   GTS_header={}
-  msg = codes_gts_new_from_file(f1)
-  if msg is None :
+  gtspos = gts_message_position(data)
+  if gtspos is None :
     print_debug('... no GTS header found')
-    f1.close()
     return None
 # It may happen that a GTS message can not be decoded by ecCodes (mal-formed header?)
+  try :
+    msg = codes_new_from_message(data[gtspos[0]:gtspos[0]+gtspos[1]])
+  except CodesInternalError as err :
+    print_debug('... no GTS header found')
+    return None
   for key in keylist :
     GTS_header[key] = codes_get(msg, key)
   codes_release(msg)
-  f1.close()
   return GTS_header
 
 def gts_from_filename(fullname) :
-# only works for TTAAII_CCCC_YYGGgg[_BBB]
-  filename = os.path.basename(fullname)
+# only works for TTAAII_CCCC_YYGGgg[_BBB] (also in an archive)
+  (archive, member) = split_archive_name(fullname)
+  filename = os.path.basename(fullname if member is None else member)
   if len(filename) != 18 and len(filename) != 22 :
     return None
   if filename[6] != '_' or filename[11] != '_' :
@@ -80,6 +516,9 @@ def gts_from_filename(fullname) :
     if filename[18] != '_' :
       return None
     gtsheader['BBB'] = filename[19:22]
+  # e.g. a copy named ISMA45_EHDB_xx1330: then the decoded header is used
+  if not filename[12:18].isdigit() :
+    return None
 
   return gtsheader
 
@@ -91,6 +530,9 @@ def gts_date(gts, basedate) :
   # because you get e.g. 31th of April -> big crash
   # this can happen on 31 May in 23h directory...
   # so we give 1 day margin
+  if not str(gts['YY']).isdigit() :
+    print_debug("... GTS Date error "+str(gts['YY']))
+    return None
   if int(gts['YY']) <= basedate.day + 1 :
     gyear = basedate.year
     gmonth = basedate.month
@@ -108,27 +550,120 @@ def gts_date(gts, basedate) :
     result = None
   return result
 
+# the value of a key for all subsets of a message (as a numpy array)
+# one call to codes_get_array if possible (a compressed message may also
+# have a single value for all subsets), else one (slow) call per subset
+def subset_array(bmsg, key, subset_count) :
+  try :
+    values = np.asarray(codes_get_array(bmsg, key))
+    if len(values) == subset_count :
+      return values
+    if len(values) == 1 and codes_get(bmsg, 'compressedData') :
+      return np.repeat(values, subset_count)
+  except CodesInternalError as err :
+    pass
+# sometimes "/subsetNumber=%d/%s" doesn't work ("subsetNumber" not defined?), but this does:
+  return np.asarray([ codes_get(bmsg, '#%d#%s' % (i+1, key))
+                      for i in range(subset_count) ])
+
+# zero padding of the numerical station identifiers
+sid_width = {'blockNumber':2, 'stationNumber':3, 'buoyOrPlatformIdentifier':5}
+def sid_format(key, values) :
+  values = np.asarray(values)
+  if key in sid_width :
+    return np.char.zfill(values.astype(str), sid_width[key]).tolist()
+  return values.astype(str).tolist()
+
+##########################################################
+# the parsed subsets of a GTS file, stored by column:
+#   shared : values that are the same for all subsets (message position, date)
+#   columns : key -> list with one value for every subset
+#   gtsheader : the GTS header (incl. TIMESTAMP), set by parse_gts_file()
+#   route : how it was decoded ('fast', 'slow' or 'cache'), not stored
+# For compatibility, batch['subcount'], batch['gtsheader'] and batch['bufrlist']
+# still give the old dict view (bufrlist is a list of dicts, one per subset).
+class SubsetBatch :
+  __slots__ = ('subcount', 'shared', 'columns', 'gtsheader', 'route')
+
+  def __init__(self, subcount, shared, columns, gtsheader=None, route=None) :
+    self.subcount = subcount
+    self.shared = shared
+    self.columns = columns
+    self.gtsheader = gtsheader
+    self.route = route
+
+  def __getitem__(self, key) :
+    if key == 'subcount' :
+      return self.subcount
+    if key == 'gtsheader' :
+      return self.gtsheader
+    if key == 'bufrlist' :
+      return self.labels()
+    raise KeyError(key)
+
+  def labels(self) :
+    result = [ dict(self.shared) for i in range(self.subcount) ]
+    for key in self.columns :
+      for i in range(self.subcount) : result[i][key] = self.columns[key][i]
+    return result
+
+  # one tuple per subset with the values for the given column names
+  # (subset values before shared values before GTS header)
+  def rows(self, names, extra={}, gtsheader=None) :
+    if gtsheader is None :
+      gtsheader = self.gtsheader
+    cols = []
+    for key in names :
+      if key in self.columns :
+        cols.append(self.columns[key])
+      elif key in self.shared :
+        cols.append(itertools.repeat(self.shared[key], self.subcount))
+      elif key in gtsheader :
+        cols.append(itertools.repeat(gtsheader[key], self.subcount))
+      else :
+        cols.append(itertools.repeat(extra.get(key), self.subcount))
+    return zip(*cols)
+
+# for the parse cache (json)
+def subset_batch_to_dict(batch) :
+  return {'subcount':batch.subcount, 'shared':batch.shared, 'columns':batch.columns}
+
+def subset_batch_from_dict(bdict) :
+  # older parse caches have a list of dicts, one per subset
+  if isinstance(bdict, list) :
+    columns = {}
+    for i in range(len(bdict)) :
+      for key in bdict[i] :
+        if key not in columns : columns[key] = [None] * len(bdict)
+        columns[key][i] = bdict[i][key]
+    return SubsetBatch(len(bdict), {}, columns, route='cache')
+  return SubsetBatch(bdict['subcount'], bdict['shared'], bdict['columns'], route='cache')
+
 # TODO: this fails for too many files:w
 # What to do if blockNumber, stationNumber are not defined for the subsets?
 # rounding for lat/lon (not so important)
 # sometimes GTS header seems corrupted, but the rest is OK...
-def parse_subsets (filename) :
-  if not os.path.exists(filename) :
-    return 1
-  f1 = open(filename)
-
-  try :
-    bufr_count = codes_count_in_file(f1)
-  except CodesInternalError as err :
-    print_debug("... error counting BUFR messages")
-    bufr_count = 0
+# light: decode as little as possible (for indexing)
+#   no key attributes, no lat/lon (they are not in the index),
+#   and no unpacking at all if there are no station identifiers
+# base: the offset of data in the file (for a bulletin of a bundled file)
+def parse_subsets (filename, data=None, light=False, base=0) :
+  if data is None :
+    if not os.path.exists(filename) :
+      return 1
+    data = read_gts_file(filename)
+
+  bufr_list = bufr_message_list(data)
+  bufr_count = len(bufr_list)
 
   if bufr_count == 0 :
     print_debug('... No valid BUFR message')
+    metrics_reject('no_bufr')
     return None
 #    return {count:0}
   if bufr_count > 1 :
     print_debug('... More than 1 BUFR message')
+    metrics_reject('multi_message')
     return None
 #    return {count:bufr_count}
 
@@ -138,138 +673,355 @@ def parse_subsets (filename) :
                "shipOrMobileLandStationIdentifier",
                'buoyOrPlatformIdentifier',
                'stationaryBuoyPlatformIdentifierEGCManBuoys']
+  # the descriptors of these keys: 001001, 001002, 001011, 001005, 001010
+  SID_descriptors = set([1001, 1002, 1011, 1005, 1010])
   main_keys=["typicalDate", "typicalTime"]
 
-  bufr_labels = None
-  f1.seek(0)
-  while 1 :
-    try :
-      bmsg = codes_bufr_new_from_file(f1)
-      if bmsg is None :
-        break
-#      bufr_count += 1
-#      if bufr_count > 1 :
-#        print_debug("More than 1 BUFR message in file !")
-      subset_count = codes_get(bmsg, "numberOfSubsets")
+  batch = None
+  (offset, length) = bufr_list[0]
+  bmsg = None
+  try :
+    bmsg = codes_new_from_message(data[offset:offset+length])
+    subset_count = codes_get(bmsg, "numberOfSubsets")
 #      print_debug("BUFR message has "+str(subset_count)+" submessages")
-      compressed = codes_get(bmsg, 'compressedData')
+    compressed = codes_get(bmsg, 'compressedData')
+    # the header keys and descriptors are available without unpacking
+    if light :
+      codes_set(bmsg, 'skipExtraKeyAttributes', 1)
+      descriptors = codes_get_array(bmsg, 'expandedDescriptors')
+      unpack = not SID_descriptors.isdisjoint(descriptors.tolist())
+    else :
+      unpack = True
+    if unpack :
       codes_set(bmsg, 'unpack', 1)
 
-      bufr_labels=[ {'subset':i+1} for i in range(subset_count) ]
-      for key in main_keys :
-        bkey = codes_get(bmsg, key)
-        for i in range(subset_count) : bufr_labels[i][key] = bkey
+    # the position of the BUFR message in the GTS file is kept in the index,
+    # so single subset messages can later be copied without decoding
+    shared = {'nsubsets':subset_count, 'msgoffset':base + offset, 'msglength':length}
+    for key in main_keys :
+      shared[key] = codes_get(bmsg, key)
+    columns = {'subset' : list(range(1, subset_count + 1))}
+
+    for key in subset_keys :
+      columns[key] = [None] * subset_count
+      if light : continue
+      try :
+        if compressed or subset_count == 1 :
+          columns[key][0] = codes_get(bmsg, key)
+        else :
+          columns[key] = subset_array(bmsg, key, subset_count).tolist()
+      except CodesInternalError as err :
+        print_debug('... error reading BUFR key ' + key)
 
-      for key in subset_keys :
-        try :
-          if compressed or subset_count == 1 :
-            bkey = codes_get(bmsg, key)
-            bufr_labels[0][key] = bkey
-          else :
-            for i in range(subset_count) :
-#              bkey = codes_get(bmsg, '/subsetNumber=%d/%s' % (i+1, key))
-# sometimes this doesn't work ("subsetNumber" not defined?), but the following does:
-              bkey = codes_get(bmsg, '#%d#%s' % (i+1, key))
-              bufr_labels[i][key] = bkey
-        except CodesInternalError as err :
-          print_debug('... error reading BUFR key ' + key)
-          for i in range(subset_count) : bufr_labels[i][key] = None
-
-      for i in range(subset_count) : bufr_labels[i]['SID'] = ''
+    sid = [''] * subset_count
 # stationNumber can be combined with blockNumber, but then it MUST be 3 characters
-      for key in SID_keys :
-        try :
-          if not codes_is_defined(bmsg, key) : continue
-          if subset_count == 1 :
-            bkey = codes_get(bmsg, key)
-            if key=='blockNumber' :
-              bkey =  '%02d' % bkey
-            if key=='stationNumber' :
-              bkey = '%03d' % bkey
-            if key=='buoyOrPlatformIdentifier' :
-              bkey = '%05d' % bkey
-            bufr_labels[0]['SID'] += bkey
-
-          else :
-            if compressed :
-              klen = codes_get_size(bmsg, key)
-              if klen == 1 :
-                bkey = codes_get(bmsg, key)
-                if key=='blockNumber' : bkey =  '%02d' % bkey
-                if key=='stationNumber' : bkey = '%03d' % bkey
-                if key=='buoyOrPlatformIdentifier' : bkey = '%05d' % bkey
-                for i in range(subset_count) : bufr_labels[i]['SID'] += bkey
-              else :
-                bkey = codes_get_array(bmsg, key)
-                if key=='blockNumber' :
-                  bkey = [ '%02d' % bkey[i] for i in range(subset_count)]
-                if key=='stationNumber' :
-                  bkey = [ '%03d' % bkey[i] for i in range(subset_count)]
-                if key=='buoyOrPlatformIdentifier' :
-                  bkey = [ '%05d' % bkey[i] for i in range(subset_count)]
-                for i in range(subset_count) : bufr_labels[i]['SID'] += bkey[i]
-
-            else :
-              for i in range(subset_count) :
-# BUG for shipOrMobileLandStationIdentifier :
-#                bkey = codes_get(bmsg, '/subsetNumber=%d/%s' % (i+1, key))
-                bkey = codes_get(bmsg, '#%d#%s' % (i+1, key))
-                if key=='blockNumber' :
-                  bkey = '%0*d' % (2, bkey)
-                if key=='stationNumber' :
-                  bkey = '%03d' % bkey
-                if key=='buoyOrPlatformIdentifier' :
-                  bkey = '%05d' % bkey
-                bufr_labels[i]['SID'] += bkey
-
-        except CodesInternalError as err :
-          print_debug('... error reading BUFR key ' + key)
+    for key in SID_keys :
+      if not unpack : break
+      try :
+        if not codes_is_defined(bmsg, key) : continue
+        if subset_count == 1 :
+          bkey = sid_format(key, [codes_get(bmsg, key)])
+        else :
+          bkey = sid_format(key, subset_array(bmsg, key, subset_count))
+        sid = [ sid[i] + bkey[i] for i in range(subset_count) ]
+      except CodesInternalError as err :
+        print_debug('... error reading BUFR key ' + key)
+    columns['SID'] = sid
+    batch = SubsetBatch(subset_count, shared, columns,
+                        route='slow' if unpack else 'fast')
+
+    codes_release(bmsg)
+  except CodesInternalError as err :
+    print_debug("... error reading BUFR message")
+    metrics_reject('decode_error')
+    if bmsg is not None : codes_release(bmsg)
 
-      codes_release(bmsg)
-    except CodesInternalError as err :
-      print_debug("... error reading BUFR message")
-      codes_release(bmsg)
+  return batch  
 
-  f1.close()
-  return bufr_labels  
 
 
+##########################################################
+# persistent parse cache, shared by all cycles
+# Every GTS file is scanned by many overlapping cycles, so we keep the decoded
+# GTS header and the subset labels in a separate SQLite file.
+# An entry is only valid for the same (path, size, mtime).
+# Negative results are stored too (status):
+#   'noheader' : no valid GTS header (not even from file name)
+#   'header'   : header is known, but BUFR was not decoded yet (filtered out)
+#   'bad'      : BUFR could not be used (corrupt, empty, >1 message)
+#   'ok'       : header and subset labels
+#   'bundle'   : many bulletins in the file (see parse_bundle), not cached
+# light: the BUFR was decoded with light=True (see parse_subsets), so there is
+#   no longitude/latitude: such an entry is decoded again for light=False
+#   (entries of older caches count as light)
+def parse_cache_filename(SQL_path) :
+  filename = os.path.join(SQL_path, 'parse_cache.sqlite')
+  return filename
+
+def open_parse_cache(cachefile) :
+  # several cycles (or processes) may use the same cache at once
+  cache = sqlite3.connect(cachefile, timeout=60)
+  cache.execute('PRAGMA journal_mode=WAL')
+  cache.execute('PRAGMA synchronous=NORMAL')
+  table_def_cache = 'CREATE TABLE IF NOT EXISTS parsed ( \
+                     path VARCHAR PRIMARY KEY, size INTEGER, mtime INTEGER, \
+                     status VARCHAR, gtsheader VARCHAR, bufrlist VARCHAR, light INTEGER)'
+  cache.execute(table_def_cache)
+  columns = [ x[1] for x in cache.execute('PRAGMA table_info(parsed)') ]
+  if 'light' not in columns :
+    cache.execute('ALTER TABLE parsed ADD COLUMN light INTEGER DEFAULT 1')
+  cache.commit()
+  return cache
+
+# for a file in an archive: the signature of the archive
+def file_signature(fullname) :
+  fstat = os.stat(split_archive_name(fullname)[0])
+  return (fstat.st_size, fstat.st_mtime_ns)
+
+# returns None if the file is not in the cache (or has been modified)
+def parse_cache_lookup(cache, fullname, signature) :
+  z1 = cache.execute('SELECT size, mtime, status, gtsheader, bufrlist, light \
+                      FROM parsed WHERE path=?', (fullname,))
+  x1 = z1.fetchone()
+  if x1 is None or (x1[0], x1[1]) != signature :
+    return None
+  print_debug('... found in parse cache: ' + x1[2])
+  result = {'status' : x1[2], 'gtsheader' : None, 'bufrlist' : None, 'light' : x1[5] != 0}
+  if x1[3] is not None :
+    result['gtsheader'] = json.loads(x1[3])
+  if x1[4] is not None :
+    result['bufrlist'] = json.loads(x1[4])
+  return result
 
-def parse_file(fullname, mindate, maxdate) :
+# The entries are committed in batches by the caller (e.g. once per chunk of
+# files, see ingest_parse), not for every file.
+# In a worker process, they are only collected (parse_cache_pending) and
+# stored by the calling process: so only 1 process writes to the cache.
+parse_cache_pending = None
+
+def parse_cache_store(cache, fullname, signature, status, gtsheader=None, bufrlist=None,
+                      light=False) :
+  if gtsheader is not None :
+    gtsheader = json.dumps(gtsheader)
+  if bufrlist is not None :
+    bufrlist = json.dumps(bufrlist)
+  row = (fullname, signature[0], signature[1], status, gtsheader, bufrlist, 1 if light else 0)
+  if parse_cache_pending is not None :
+    parse_cache_pending.append(row)
+  else :
+    parse_cache_write(cache, [row])
+
+def parse_cache_write(cache, rows) :
+  cache.executemany('INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+# to be run regularly: GTS files are not kept forever
+def cleanup_parse_cache(cachefile, maxage_days=7) :
+  cache = open_parse_cache(cachefile)
+  oldest = dt.datetime.today() - dt.timedelta(days=maxage_days)
+  # mtime is in ns
+  cache.execute('DELETE FROM parsed WHERE mtime < ?', (int(oldest.timestamp()*1e9),))
+  cache.commit()
+  cache.close()
+
+# step 2 of parse_gts_file: read the first bytes and check the raw abbreviated
+# heading, only then read the rest of the file
+# (not for bundled files: the other bulletins may be accepted)
+# returns (reason, data, size): if the file is rejected, data is only the first bytes
+def gts_read_checked(fullname, fileheader, mindate, maxdate, gfilter) :
+  t0 = metrics_start()
+  # a file in an archive is always read as a whole
+  if split_archive_name(fullname)[1] is None :
+    f1 = open(fullname, 'rb')
+    data = f1.read(gts_heading_size)
+    size = os.fstat(f1.fileno()).st_size
+  else :
+    f1 = None
+    data = read_gts_file(fullname)
+    size = len(data)
+  reason = None
+  if fileheader is None or not gfilter['filename'] :
+    rawheader = gts_from_heading(data)
+    if rawheader is not None and gts_single_bulletin(data, size) :
+      reason = gts_check(rawheader, mindate, maxdate, gfilter)
+  if f1 is not None :
+    if reason is None :
+      data += f1.read()
+    f1.close()
+  metrics_stop('io', t0)
+  return (reason, data, size)
+
+# light: light decoding (see parse_subsets)
+# skip: offsets of bulletins that are not needed (duplicates, see file_digests)
+# prefetched: the result of gts_read_checked() if the file was read already
+#   (see file_digests), so it is never read twice
+# returns a list of SubsetBatch, one for every accepted bulletin
+# (a file has mostly only 1 bulletin, see parse_bundle for the others)
+def parse_gts_file(fullname, mindate, maxdate, cache=None, gfilter=None, light=False, skip=None,
+                   prefetched=None) :
   print_debug('Parsing: '+fullname)
-  gtsheader = get_gts_headers(fullname)
-  # local files may not have a transmission sequence number
-  # so ecCodes can not read the GTS headers
-  if gtsheader is None :
-    print_debug('... Trying GTS from file name')
-    gtsheader = gts_from_filename(fullname)
-    if gtsheader is None :
+  metrics_count('files_parsed')
+  if gfilter is None :
+    gfilter = gts_filter_default
+  # 1. quick rejection on the file name: no I/O at all
+  fileheader = gts_from_filename(fullname)
+  if fileheader is not None and gfilter['filename'] :
+    reason = gts_check(fileheader, mindate, maxdate, gfilter)
+    if reason is not None :
+      print_debug('... ' + reason + ' (file name)')
+      metrics_reject(reason)
+      return []
+
+  cached = None
+  if cache is not None :
+    signature = file_signature(fullname)
+    cached = parse_cache_lookup(cache, fullname, signature)
+
+  # the file is read only once, and only if we need to decode it
+  data = None
+  if prefetched is not None and prefetched[0] is None :
+    data = prefetched[1]
+  if cached is not None and cached['status'] == 'bundle' :
+    if data is None :
+      t0 = metrics_start()
+      data = read_gts_file(fullname)
+      metrics_stop('io', t0)
+    return parse_bundle(fullname, data, gts_bulletin_index(data), mindate, maxdate,
+                        gfilter, light, skip)
+  if cached is not None :
+    if cached['status'] == 'noheader' :
       print_debug('... No valid GTS header ')
-      return None
-
+      metrics_reject('no_header')
+      return []
+    gtsheader = cached['gtsheader']
+  else :
+    # 2. quick rejection on the raw abbreviated heading: just a few bytes
+    if prefetched is None :
+      prefetched = gts_read_checked(fullname, fileheader, mindate, maxdate, gfilter)
+    (reason, data, size) = prefetched
+    if reason is not None :
+      print_debug('... ' + reason + ' (heading)')
+      metrics_reject(reason)
+      return []
+    bulletins = gts_bulletin_index(data)
+    if len(bulletins) > 1 :
+      print_debug('... %i bulletins' % len(bulletins))
+      if cache is not None :
+        parse_cache_store(cache, fullname, signature, 'bundle')
+      return parse_bundle(fullname, data, bulletins, mindate, maxdate, gfilter, light, skip)
+    t0 = metrics_start()
+    gtsheader = get_gts_headers(fullname, data)
+    metrics_stop('decode', t0)
+    # local files may not have a transmission sequence number
+    # so ecCodes can not read the GTS headers
+    if gtsheader is None :
+      print_debug('... Trying GTS from file name')
+      gtsheader = fileheader
+      if gtsheader is None :
+        print_debug('... No valid GTS header ')
+        metrics_reject('no_header')
+        if cache is not None :
+          parse_cache_store(cache, fullname, signature, 'noheader')
+        return []
+
+  # 3. the full check on the decoded header
+  reason = gts_check(gtsheader, mindate, maxdate, gfilter)
+  if reason is not None :
+    print_debug('... ' + reason)
+    metrics_reject(reason)
+    # the BUFR is not decoded, only the header is stored
+    if cache is not None and cached is None :
+      parse_cache_store(cache, fullname, signature, 'header', gtsheader)
+    return []
   gdt = gts_date(gtsheader, maxdate)
-  if gdt is None :
-    print_debug('... No valid date retrieved.')
-    return None
 
-  if gdt < mindate or gdt > maxdate :
-    print_debug ('... Not in time window')
-    return None
+  # (a light entry is not enough for a full decode)
+  if cached is not None and cached['status'] in ['ok', 'bad'] and (light or not cached['light']) :
+    batch = None
+    if cached['bufrlist'] is not None :
+      batch = subset_batch_from_dict(cached['bufrlist'])
+    else :
+      metrics_reject('bad_bufr_cached')
+  else :
+    if data is None :
+      t0 = metrics_start()
+      data = read_gts_file(fullname)
+      metrics_stop('io', t0)
+    t0 = metrics_start()
+    batch = parse_subsets(fullname, data, light)
+    metrics_stop('decode', t0)
+    if cache is not None :
+      if batch is None :
+        parse_cache_store(cache, fullname, signature, 'bad', gtsheader, light=light)
+      else :
+        parse_cache_store(cache, fullname, signature, 'ok', gtsheader,
+                          subset_batch_to_dict(batch), light)
 
-  if not gts_filter(gtsheader) :
-    print_debug('... Not in Europe')
-    return None
+  if batch is None :
+    return []
 
   gtsheader['TIMESTAMP'] = gdt.strftime('%Y%m%d-%H%M%S')
-  bufrlist = parse_subsets(fullname)
-
-  if bufrlist is None :
-    return None
-
-  subcount = len(bufrlist)
+  batch.gtsheader = gtsheader
+  metrics_count('files_accepted')
+  metrics_count('subsets_parsed', batch.subcount)
 #      if subcount > 1 : print_debug "SUBSETS YEAHA"
 #      print_debug sublist
-  return {'subcount':subcount, 'gtsheader':gtsheader, 'bufrlist':bufrlist}
+  return [batch]
+
+# bundled GTS files: every bulletin is checked and decoded on its own
+# its BUFR message keeps its position in the file (msgoffset), so it can be
+# extracted later without reading the rest of the file
+# the offset of the bulletin is kept in the batch (shared 'bulletin')
+# bundles are not kept in the parse cache, only the fact that it is a bundle
+def parse_bundle(fullname, data, bulletins, mindate, maxdate, gfilter, light=False, skip=None) :
+  result = []
+  for (offset, length, rawheader) in bulletins :
+    metrics_count('bulletins_parsed')
+    if skip is not None and offset in skip :
+      continue
+    if rawheader is not None :
+      reason = gts_check(rawheader, mindate, maxdate, gfilter)
+      if reason is not None :
+        print_debug('... ' + reason + ' (bulletin at %i)' % offset)
+        metrics_reject(reason)
+        continue
+    bulletin = data[offset:offset+length]
+    t0 = metrics_start()
+    gtsheader = get_gts_headers(fullname, bulletin)
+    metrics_stop('decode', t0)
+    if gtsheader is None :
+      gtsheader = rawheader
+    if gtsheader is None :
+      print_debug('... No valid GTS header (bulletin at %i)' % offset)
+      metrics_reject('no_header')
+      continue
+    reason = gts_check(gtsheader, mindate, maxdate, gfilter)
+    if reason is not None :
+      print_debug('... ' + reason + ' (bulletin at %i)' % offset)
+      metrics_reject(reason)
+      continue
+    t0 = metrics_start()
+    batch = parse_subsets(fullname, bulletin, light, offset)
+    metrics_stop('decode', t0)
+    if batch is None :
+      continue
+    gtsheader['TIMESTAMP'] = gts_date(gtsheader, maxdate).strftime('%Y%m%d-%H%M%S')
+    batch.gtsheader = gtsheader
+    batch.shared['bulletin'] = offset
+    metrics_count('subsets_parsed', batch.subcount)
+    result.append(batch)
+  if len(result) > 0 :
+    metrics_count('files_accepted')
+  return result
+
+# for a file with a single bulletin: returns a SubsetBatch or None
+# (for a bundled file, only the first accepted bulletin, see parse_gts_file)
+def parse_file(fullname, mindate, maxdate, cache=None, gfilter=None, light=False) :
+  batches = parse_gts_file(fullname, mindate, maxdate, cache, gfilter, light)
+  if cache is not None :
+    cache.commit()
+  if len(batches) == 0 :
+    return None
+  return batches[0]
 
 # you have two entries with the same keys
 # which one has priority?
@@ -292,129 +1044,784 @@ def gts_priority(row1, row2) :
   else :
     return True
 
+# BBB is stored as a small integer:
+#   0     : no BBB (NNN)
+#   1-26  : CCA-CCZ (corrections), 27-52 : RRA-RRZ, 53-78 : AAA-AAZ
+#   other : the 3 characters (ASCII, 24 bit)
+# so a correction is in 1-26, or an odd "CC?" as 3 characters (see bbb_rank_sql)
+bbb_prefixes = ['CC', 'RR', 'AA']
+def bbb_encode(BBB) :
+  if BBB is None or BBB == 'NNN' :
+    return 0
+  if len(BBB) == 3 and BBB[0:2] in bbb_prefixes and 'A' <= BBB[2] <= 'Z' :
+    return 1 + 26 * bbb_prefixes.index(BBB[0:2]) + ord(BBB[2]) - ord('A')
+  return int.from_bytes(BBB[0:3].ljust(3).encode('latin-1'), 'big')
+
+def bbb_decode(code) :
+  if code is None or code == 0 :
+    return 'NNN'
+  if code <= 26 * len(bbb_prefixes) :
+    return bbb_prefixes[(code - 1) // 26] + chr(ord('A') + (code - 1) % 26)
+  return code.to_bytes(3, 'big').decode('latin-1').rstrip(' ')
+
+# the same in SQL (for the data view)
+bbb_decode_sql = "CASE WHEN obs.BBB = 0 THEN 'NNN' \
+                    WHEN obs.BBB <= 78 THEN substr('CCRRAA', 2 * ((obs.BBB - 1) / 26) + 1, 2) \
+                                            || char(65 + (obs.BBB - 1) % 26) \
+                    ELSE rtrim(char(obs.BBB >> 16, (obs.BBB >> 8) & 255, obs.BBB & 255)) END"
+
+# the BBB code in the order of gts_priority(): CCA-CCZ are ranked as their
+# 3 characters, like the odd corrections (e.g. "CC1"), so a correction is
+# "CC?" (rank >> 8) and 2 corrections are compared as strings
+bbb_cc = int.from_bytes(b'CC', 'big')
+def bbb_rank_sql(table) :
+  return '(CASE WHEN %s.BBB BETWEEN 1 AND 26 THEN %s.BBB + %i ELSE %s.BBB END)' % \
+         (table, table, int.from_bytes(b'CC@', 'big'), table)
+
+# insert all subsets of a file in one go, using the primary key of obs:
+#   bulletin (TT, AA, II, CCCC, TIMESTAMP), SID
+# an existing row is only replaced if the new one has priority:
+# this is exactly "not gts_priority(obs.BBB, excluded.BBB)" (see bbb_rank_sql)
+obs_columns = ['TT', 'AA', 'II', 'CCCC', 'TIMESTAMP', 'BBB', 'SID',
+               'filename', 'subset', 'nsubsets', 'msgoffset', 'msglength']
+upsert_obs = "INSERT INTO obs (bulletin_id, SID, BBB, file_id, \
+                subset, nsubsets, msgoffset, msglength) VALUES ( \
+                ?, ?, ?, ?, ?, ?, ?, ?) \
+              ON CONFLICT (bulletin_id, SID) DO UPDATE SET \
+                file_id=excluded.file_id, subset=excluded.subset,\
+                nsubsets=excluded.nsubsets, msgoffset=excluded.msgoffset,\
+                msglength=excluded.msglength, BBB=excluded.BBB \
+              WHERE (%(new)s >> 8) = %(cc)i AND \
+                ((%(old)s >> 8) != %(cc)i OR %(new)s > %(old)s)" % \
+             {'new' : bbb_rank_sql('excluded'), 'old' : bbb_rank_sql('obs'), 'cc' : bbb_cc}
+
+# the id of a file (full name), it is added if needed
+def sqlite_file_id(db, filename) :
+  x1 = db.execute('SELECT file_id FROM files WHERE filename=?', (filename,)).fetchone()
+  if x1 is not None :
+    return x1[0]
+  return db.execute('INSERT INTO files (filename) VALUES (?)', (filename,)).lastrowid
+
+# the id of a bulletin (the GTS header without BBB), it is added if needed
+def sqlite_bulletin_id(db, TT, AA, II, CCCC, TIMESTAMP) :
+  x1 = db.execute('SELECT bulletin_id FROM bulletins \
+                   WHERE TT=? AND AA=? AND II=? AND CCCC=? AND TIMESTAMP=?',
+                  (TT, AA, II, CCCC, TIMESTAMP)).fetchone()
+  if x1 is not None :
+    return x1[0]
+  return db.execute('INSERT INTO bulletins (TT, AA, II, CCCC, TIMESTAMP) VALUES (?, ?, ?, ?, ?)',
+                    (TT, AA, II, CCCC, TIMESTAMP)).lastrowid
+
+# observations (tuples as obs_columns) -> rows for upsert_obs
+# (mostly many observations of the same file and bulletin come together)
+def sqlite_obs_rows(db, observations) :
+  result = []
+  (filename, file_id) = (None, None)
+  (bulletin, bulletin_id) = (None, None)
+  for obs in observations :
+    if obs[7] != filename :
+      (filename, file_id) = (obs[7], sqlite_file_id(db, obs[7]))
+    if obs[0:5] != bulletin :
+      (bulletin, bulletin_id) = (obs[0:5], sqlite_bulletin_id(db, *obs[0:5]))
+    result.append((bulletin_id, obs[6], bbb_encode(obs[5]), file_id) + tuple(obs[8:12]))
+  return result
+
+# flist: SubsetBatch as returned by parse_gts_file()
+# gtsheader: use another GTS header (TIMESTAMP) than the one in flist
+# (entries from an older parse cache have no message position: NULL)
+def sqlite_add_obs(db, fullname, flist, gtsheader=None) :
+  t0 = metrics_start()
+  rows = sqlite_obs_rows(db, flist.rows(obs_columns, {'filename':fullname}, gtsheader))
+  if metrics is None :
+    db.executemany(upsert_obs, rows)
+    return
+  # an insert adds a row for the bulletin, a replacement does not,
+  # a duplicate (or older correction) changes nothing
+  bulletins = sorted(set([ x[0] for x in rows ]))
+  count_obs = 'SELECT count(*) FROM obs WHERE bulletin_id IN (%s)' % ','.join(['?'] * len(bulletins))
+  before = db.execute(count_obs, bulletins).fetchone()[0]
+  changes = db.total_changes
+  db.executemany(upsert_obs, rows)
+  changes = db.total_changes - changes
+  added = db.execute(count_obs, bulletins).fetchone()[0] - before
+  metrics_count('subsets_added', added)
+  metrics_count('subsets_replaced', changes - added)
+  metrics_count('subsets_duplicate', flist.subcount - changes)
+  metrics_stop('sqlite', t0)
+
+##########################################################
+# index backends: where update_sqlite() merges the observations of a cycle
+#   'sqlite' : every batch is an upsert in the cycle data base (sqlite_add_obs)
+#   'memory' : a dict {obs_key : observation}, gts_priority() in python
+#     The dict is loaded from the cycle data base at the start, and the changed
+#     observations are written back with 1 executemany at the end (index_flush).
+#     Everything (also the scanned files) is then committed in 1 transaction,
+#     so after a crash the run simply starts again. Fast for batch backfills,
+#     but commit_every is ignored and the dict grows with the cycle.
+index_backends = ['sqlite', 'memory']
+
+def index_open(db, backend='sqlite') :
+  if backend not in index_backends :
+    raise ValueError('unknown index backend ' + str(backend))
+  index = {'backend' : backend, 'db' : db}
+  if backend == 'memory' :
+    t0 = metrics_start()
+    z1 = db.execute('SELECT ' + ', '.join(obs_columns) + ' FROM data')
+    index['obs'] = dict( (obs_key(x), x) for x in z1 )
+    index['changed'] = set()
+    metrics_stop('sqlite', t0)
+  return index
+
+# the same as sqlite_add_obs()
+def index_add_obs(index, fullname, flist, gtsheader=None) :
+  if index['backend'] == 'sqlite' :
+    sqlite_add_obs(index['db'], fullname, flist, gtsheader)
+    return
+  t0 = metrics_start()
+  obslist = index['obs']
+  added = 0
+  replaced = 0
+  for obs in flist.rows(obs_columns, {'filename':fullname}, gtsheader) :
+    key = obs_key(obs)
+    old = obslist.get(key)
+    if old is None :
+      added += 1
+    elif gts_priority(old[5], obs[5]) :
+      continue
+    else :
+      replaced += 1
+    obslist[key] = obs
+    index['changed'].add(key)
+  metrics_count('subsets_added', added)
+  metrics_count('subsets_replaced', replaced)
+  metrics_count('subsets_duplicate', flist.subcount - added - replaced)
+  metrics_stop('index', t0)
+
+# at the points where the ingestion commits (see commit_every)
+def index_commit(index) :
+  if index['backend'] == 'sqlite' :
+    index['db'].commit()
+
+# write everything to the cycle data base
+def index_flush(index) :
+  db = index['db']
+  if index['backend'] == 'memory' and len(index['changed']) > 0 :
+    t0 = metrics_start()
+    obslist = index['obs']
+    db.executemany(upsert_obs, sqlite_obs_rows(db, [ obslist[key] for key in sorted(index['changed']) ]))
+    index['changed'] = set()
+    metrics_stop('sqlite', t0)
+  db.commit()
+
+##########################################################
+# parallel ingestion: the workers only parse the GTS files,
+# the merge into the SQLite file is done by the calling process (single writer)
+# every worker process opens its own connection to the parse cache (to read:
+# the new entries are returned with the result, see parse_cache_store)
+parse_worker_cache = None
+parse_worker_filter = None
+parse_worker_light = False
+def parse_worker_init(parse_cache, gfilter=None, light=False) :
+  global parse_worker_cache, parse_worker_filter, parse_worker_light, parse_cache_pending
+  if parse_cache is not None :
+    parse_worker_cache = open_parse_cache(parse_cache)
+    parse_cache_pending = []
+  parse_worker_filter = gfilter
+  parse_worker_light = light
+
+# returns the result, the metrics for this file (None if disabled) and the
+# new parse cache entries
+def parse_worker(args) :
+  (fullname, mindate, maxdate, skip, prefetched, with_metrics) = args
+  if with_metrics :
+    metrics_enable()
+  else :
+    metrics_disable()
+  result = parse_gts_file(fullname, mindate, maxdate, parse_worker_cache, parse_worker_filter,
+                          parse_worker_light, skip, prefetched)
+  rows = []
+  if parse_cache_pending is not None :
+    rows = parse_cache_pending[:]
+    del parse_cache_pending[:]
+  return (result, metrics, rows)
+
+# all settings for parsing GTS files, shared by all cycles:
+# parse_cache: file name of a (shared) parse cache, e.g. parse_cache_filename(SQL_path)
+# workers: number of parallel parsing processes
+#   the results are merged in the same (sorted) file order as the serial run,
+#   so the result is identical
+# filter_spec: GTS filter (see gts_filter_spec), default is BUFR-SYNOP for Europe
+# commit_every: commit after every N files (default: once per directory)
+# light_decode: decode only what is needed for the index (see parse_subsets)
+#   the number of messages per route (fast: not unpacked, slow: unpacked,
+#   cache: from the parse cache) is reported at the end
+# dedup: skip byte-identical copies of bulletins (see bulletin_digest)
+# The files of a directory are handled in chunks of a few files per worker:
+# a chunk is read and deduplicated just before it is parsed, so only the
+# bytes of 1 chunk are kept in memory (and sent to the workers).
+def ingest_setup(parse_cache=None, workers=1, filter_spec=None, commit_every=None,
+                 light_decode=True, dedup=True) :
+  ingest = {'parse_cache' : parse_cache, 'workers' : workers,
+            'commit_every' : commit_every, 'pool' : None, 'dedup' : dedup,
+            'chunk' : 16 * max(workers, 4),
+            'light' : light_decode, 'routes' : {'fast':0, 'slow':0, 'cache':0}}
+  if parse_cache is not None :
+    print('Using parse cache ' + parse_cache)
+    ingest['cache'] = open_parse_cache(parse_cache)
+  else :
+    ingest['cache'] = None
+  if filter_spec is not None :
+    ingest['gfilter'] = compile_gts_filter(filter_spec)
+  else :
+    ingest['gfilter'] = gts_filter_default
+  return ingest
+
+# the worker processes are only started when there is something to parse
+def ingest_pool(ingest) :
+  if ingest['workers'] > 1 and ingest['pool'] is None :
+    print('Parsing with %i worker processes' % ingest['workers'])
+    ingest['pool'] = multiprocessing.Pool(ingest['workers'], parse_worker_init,
+                                          (ingest['parse_cache'], ingest['gfilter'],
+                                           ingest['light']))
+  return ingest['pool']
+
+# parse a list of files (in parallel if possible)
+# skip_list: for every file, the bulletins to skip (see parse_gts_file)
+# prefetch_list: for every file, what was read already (see file_digests)
+# returns an iterator over the results (a list of SubsetBatch), in the same order
+# the new parse cache entries are not committed yet (see ingest_commit_cache)
+def ingest_parse(ingest, full_list, mindate, maxdate, skip_list=None, prefetch_list=None) :
+  if skip_list is None :
+    skip_list = [None] * len(full_list)
+  if prefetch_list is None :
+    prefetch_list = [None] * len(full_list)
+  if len(full_list) > 0 :
+    pool = ingest_pool(ingest)
+  else :
+    pool = None
+  if pool is None :
+    parsed = ( parse_gts_file(fullname, mindate, maxdate, ingest['cache'], ingest['gfilter'],
+                              ingest['light'], skip, prefetched)
+               for (fullname, skip, prefetched) in zip(full_list, skip_list, prefetch_list) )
+  else :
+    # imap returns the results in order
+    parsed = pool.imap(parse_worker,
+                       [ (fullname, mindate, maxdate, skip, prefetched, metrics is not None)
+                         for (fullname, skip, prefetched) in zip(full_list, skip_list,
+                                                                 prefetch_list) ],
+                       chunksize=4)
+    parsed = ingest_worker_results(ingest, parsed)
+  return ingest_count_routes(ingest, parsed)
+
+# the list in chunks of at most n items
+def list_chunks(items, n) :
+  return [ items[i:i+n] for i in range(0, len(items), n) ]
+
+def ingest_worker_results(ingest, parsed) :
+  for (batches, worker_metrics, rows) in parsed :
+    metrics_merge(worker_metrics)
+    if len(rows) > 0 :
+      parse_cache_write(ingest['cache'], rows)
+    yield batches
+
+# commit the new parse cache entries, e.g. after every chunk of files
+def ingest_commit_cache(ingest) :
+  if ingest['cache'] is not None :
+    ingest['cache'].commit()
+
+def ingest_count_routes(ingest, parsed) :
+  for batches in parsed :
+    for batch in batches :
+      if batch.route is not None :
+        ingest['routes'][batch.route] += 1
+    yield batches
+
+def ingest_close(ingest) :
+  routes = ingest['routes']
+  if sum(routes.values()) > 0 :
+    print('Decoded messages: %i fast (not unpacked), %i slow (unpacked), %i from parse cache'
+          % (routes['fast'], routes['slow'], routes['cache']))
+  archive_close()
+  if ingest['cache'] is not None :
+    ingest['cache'].commit()
+    ingest['cache'].close()
+    ingest['cache'] = None
+  if ingest['pool'] is not None :
+    ingest['pool'].close()
+    ingest['pool'].join()
+    ingest['pool'] = None
 
-def update_sqlite(cycle_date, SQL_path, GTS_path, obs_window_size=60) :
 # if SQLite already exists:
 #   read meta-table for last dir read, min/maxdate, 
 # else:
 #   calculate min/maxdate, first-dir = mindate
 #   create meta-table & data-table  
+# index: the index backend (see index_open), in meta['index']
+def open_cycle_db(cycle_date, SQL_path, obs_window_size=60, index='sqlite') :
   sqlitefile = sqlite_filename(cycle_date, SQL_path)
-  print('========================')
-  print('= SYNOP GTS monitor    =')
-  print('========================')
-  print('Writing GTS data to ' + sqlitefile)
-  begintime = dt.datetime.today().strftime("%Y%m%d %H:%M:%S")
 # you create the file by just opening it
   db = sqlite3.connect(sqlitefile)
+  sqlite_tune(db)
   meta = check_create_metatable(db, cycle_date, obs_window_size)
-  obslist = check_create_datatable(db)
-
+  check_create_datatable(db)
+  check_create_scantable(db)
+  check_create_digesttable(db)
+  meta['index'] = index_open(db, index)
+  return (db, meta)
+
+# parse all new files in 1 GTS directory and add them to the cycle data base
+# returns the number of new files
+def ingest_gts_dir(db, meta, newdir, gtsdir, ingest, verbose=True) :
+  # 1. update the "last visited" directory (only for ">")
+  # this is committed together with the first files of the directory
+  # after a crash, we simply restart with the same directory
+  db.execute("UPDATE meta SET lastdir=?",(newdir,))
+  # NOTE: the directory mtime is not used to skip a directory: a scan never
+  # goes back before the last visited directory, and in that one files may
+  # still grow in place (which does not change the directory mtime)
+  # unchanged files are skipped by sqlite_new_files (size and mtime of each file)
+  # 2. get the list of new BUFR messages
+  # sorted, so the order of merging (e.g. duplicates) is always the same
+  t0 = metrics_start()
+  listing = gts_dir_listing(gtsdir)
+  metrics_stop('io', t0)
+  t0 = metrics_start()
+  file_list = sqlite_new_files(db, newdir, listing, is_gts_archive(gtsdir))
+  metrics_stop('sqlite', t0)
+  metrics_count('files_listed', len(listing))
+  metrics_count('files_new', len(file_list))
+  if verbose : print("... %i new files" % len(file_list))
+  nfiles = 0
+  duplicates = 0
+
+  # the files are read, checked and parsed in chunks (see ingest_setup)
+  for chunk in list_chunks(file_list, ingest['chunk']) :
+    # 3. skip the copies of bulletins that we already have
+    skip_list = None
+    prefetch_list = None
+    if ingest['dedup'] :
+      digests = file_digests(gtsdir, chunk, meta['mindate'], meta['maxdate'], ingest['gfilter'])
+      todo = []
+      skip_list = []
+      prefetch_list = []
+      t0 = metrics_start()
+      for (fileinfo, (digest, prefetched)) in zip(chunk, digests) :
+        skip = sqlite_duplicate_bulletins(db, digest, gts_file_path(gtsdir, fileinfo[0]))
+        if skip is None :
+          db.execute(insert_scanned, (newdir, fileinfo[0]) + fileinfo[1])
+          nfiles += 1
+          duplicates += 1
+        else :
+          todo.append(fileinfo)
+          skip_list.append(skip)
+          prefetch_list.append(prefetched)
+      metrics_stop('sqlite', t0)
+      chunk = todo
+
+    full_list = [ gts_file_path(gtsdir, filename) for (filename, signature) in chunk ]
+    parsed = ingest_parse(ingest, full_list, meta['mindate'], meta['maxdate'], skip_list,
+                          prefetch_list)
+
+    # 4. now compare to the already existing obs
+    for (fileinfo, batches) in zip(chunk, parsed) :
+      for flist in batches :
+        index_add_obs(meta['index'], gts_file_path(gtsdir, fileinfo[0]), flist)
+      # also files that are rejected: they will not change for this cycle
+      t0 = metrics_start()
+      db.execute(insert_scanned, (newdir, fileinfo[0]) + fileinfo[1])
+      nfiles += 1
+      if ingest['commit_every'] is not None and nfiles % ingest['commit_every'] == 0 :
+        index_commit(meta['index'])
+      metrics_stop('sqlite', t0)
+    ingest_commit_cache(ingest)
+  if verbose and duplicates > 0 : print("... %i duplicates skipped" % duplicates)
+  t0 = metrics_start()
+  index_commit(meta['index'])
+  metrics_stop('sqlite', t0)
+  return nfiles
+
+# scan all GTS directories for 1 cycle, starting from the last visited one
+# returns the number of new files
+def scan_gts_dirs(db, meta, cycle_date, GTS_path, ingest, verbose=True) :
   current = dt.datetime.strptime(meta['lastdir'], '%Y%m%d%H')
+  nfiles = 0
   # To get all GTS messages for a particular date/time, we need to look in all GTS input directories that
   #   were created afterwards!
   # Also, to avoid missing a few files that arrive just around "real time", 
   #   we also look in the directory started 1h before current time.
-  # we start in the same directory we finished last time (some double work...)
+  # we start in the same directory we finished last time
+  #   but we only parse the files that are new (or modified) since the last run
+  #   and skip directories that have not changed at all
   while 1 :
     newdir = current.strftime('%Y%m%d%H')
-    gtsdir = os.path.join(GTS_path, newdir)
+    gtsdir = gts_dir_path(GTS_path, newdir)
     current = current + dt.timedelta(hours=1)
 
     if current > cycle_date + dt.timedelta(hours=48) : 
-      print('Stopping GTS parsing at 48h after obs date')
+      if verbose : print('Stopping GTS parsing at 48h after obs date')
       break
 
     if not os.path.exists(gtsdir) :
       if current > dt.datetime.utcnow() :
-         print("Directory " + newdir +" doesn't exist yet.")
+         if verbose : print("Directory " + newdir +" doesn't exist yet.")
          break
       else :
-         print("Directory " + newdir +" doesn't exist.")
+         if verbose : print("Directory " + newdir +" doesn't exist.")
          continue
 
-    print("Scanning directory "+newdir)
-    # 1. update the "last visited" directory (only for ">")
-    db.execute("UPDATE meta SET lastdir=?",(newdir,))
-    db.commit()
-    # 2. get the full list of BUFR messages
-    file_list = os.listdir(gtsdir)
-
-    # some query templates :
-# THIS DOESN'T WORK... (no parameters allowed in VIEW)
-    select_gts = "CREATE TEMP VIEW gts as SELECT * FROM data WHERE \
-                  TT=':TT' AND AA=':AA' AND II=':II' \
-                  AND CCCC=':CCCC' AND TIMESTAMP=':TIMESTAMP'"
-# this works
-#                  "CREATE TEMP VIEW gts as SELECT * FROM data WHERE \
-#                  TT='IS' AND AA='NN' AND II='01' \
-#                  AND CCCC='EGRR' AND TIMESTAMP='20180228-220000'"
-    sql_test = "SELECT * FROM data WHERE \
-                  TT=:TT AND AA=:AA AND II=:II \
-                  AND CCCC=:CCCC AND TIMESTAMP=:TIMESTAMP"
-
-    select_sid = "SELECT * from gts WHERE SID=:SID"
-    write_obs = "INSERT INTO data VALUES ( \
-                   :TT, :AA, :II, :CCCC,\
-                   :TIMESTAMP, :BBB, \
-                   :SID, :filename, :subset)"
-    replace_obs = "UPDATE data SET \
-                   filename=:filename, subset=:subset,\
-                   BBB=:BBB WHERE SID=:SID AND \
-                   TT=:TT AND AA=:AA AND II=:II \
-                   AND CCCC=:CCCC AND TIMESTAMP=:TIMESTAMP"
+    if verbose : print("Scanning directory "+newdir)
+    nfiles += ingest_gts_dir(db, meta, newdir, gtsdir, ingest, verbose)
+  # the last visited directory is the one we start from next time
+  meta['lastdir'] = db.execute("SELECT lastdir FROM meta").fetchone()[0]
+  return nfiles
+
+# metrics_file: write metrics to metrics_file.json and metrics_file.prom
+# index: 'sqlite' or 'memory' (see index_open)
+def update_sqlite(cycle_date, SQL_path, GTS_path, obs_window_size=60, parse_cache=None, workers=1,
+                  filter_spec=None, commit_every=None, metrics_file=None, index='sqlite') :
+# see ingest_setup() for the options
+  if metrics_file is not None :
+    metrics_enable()
+  sqlitefile = sqlite_filename(cycle_date, SQL_path)
+  print('========================')
+  print('= SYNOP GTS monitor    =')
+  print('========================')
+  print('Writing GTS data to ' + sqlitefile)
+  begintime = dt.datetime.today().strftime("%Y%m%d %H:%M:%S")
+  (db, meta) = open_cycle_db(cycle_date, SQL_path, obs_window_size, index)
+  ingest = ingest_setup(parse_cache, workers, filter_spec, commit_every)
+  scan_gts_dirs(db, meta, cycle_date, GTS_path, ingest)
+  ingest_close(ingest)
+  index_flush(meta['index'])
+  print('Duplicate bulletins skipped for this cycle: %i' % sqlite_duplicate_count(db))
+  db.close()
+  if metrics_file is not None :
+    metrics_write(metrics_file, 'update_sqlite')
+    metrics_disable()
+    print('Metrics written to ' + metrics_file + '.json')
+  print('begin: '+begintime)
+  print('end: '+dt.datetime.today().strftime("%Y%m%d %H:%M:%S"))
+  print('= SQLITE FINISHED =')
 
- 
-    for filename in file_list :
-      fullname = os.path.join(gtsdir, filename)
-      flist = parse_file(fullname, meta['mindate'], meta['maxdate'])
-      if flist is None : 
-#        print '   ---> nothing to do'
+##########################################################
+# incremental scanning: we keep track of all files that have been handled
+# a file is considered new if name, size or mtime are different
+def check_create_scantable(db) :
+  table_def_scanned = 'CREATE TABLE IF NOT EXISTS scanned ( \
+                       dirname VARCHAR, filename VARCHAR, \
+                       size INTEGER, mtime INTEGER, \
+                       PRIMARY KEY (dirname, filename))'
+  db.execute(table_def_scanned)
+  # the directory mtimes of older versions are not used
+  db.execute('DROP TABLE IF EXISTS scandirs')
+  db.commit()
+
+insert_scanned = "INSERT OR REPLACE INTO scanned VALUES (?, ?, ?, ?)"
+
+# returns a sorted list of (filename, (size, mtime)) for all files in a directory
+def gts_dir_listing(gtsdir) :
+  if is_gts_archive(gtsdir) :
+    return archive_listing(gtsdir)
+  result = []
+  for entry in os.scandir(gtsdir) :
+    fstat = entry.stat()
+    result.append((entry.name, (fstat.st_size, fstat.st_mtime_ns)))
+  result.sort()
+  return result
+
+# only keep the files that are new for this cycle
+# archived: the listing is from an archive (see gts_dir_listing), so only the
+#   size is compared: the mtime in a tar file is in whole seconds, in a zip file
+#   in local time with 2 seconds steps, so it never matches the one of the
+#   file that was scanned before the directory was archived
+def sqlite_new_files(db, dirname, listing, archived=False) :
+  z1 = db.execute("SELECT filename, size, mtime FROM scanned WHERE dirname=?", (dirname,))
+  scanned = dict( (x[0], (x[1], x[2])) for x in z1 )
+  if archived :
+    result = [ x for x in listing if scanned.get(x[0], (None,))[0] != x[1][0] ]
+  else :
+    result = [ x for x in listing if scanned.get(x[0]) != x[1] ]
+  return result
+
+##########################################################
+# deduplication: the same bulletin often arrives several times (other GTS
+# routes, retransmissions), with exactly the same bytes.
+# Such a copy can never change the data table (same GTS tags and subsets),
+# so it is skipped before it is decoded.
+# The digest is taken over the abbreviated heading (TTAAII CCCC YYGGgg BBB) and
+# the BUFR message(s), not over the whole file: the transmission
+# sequence number changes with every retransmission.
+# Every cycle keeps the digests of all its parsed files, with the number of
+# copies that were skipped.
+def check_create_digesttable(db) :
+  table_def_digests = 'CREATE TABLE IF NOT EXISTS digests ( \
+                       digest BLOB PRIMARY KEY, filename VARCHAR, \
+                       duplicates INTEGER DEFAULT 0)'
+  db.execute(table_def_digests)
+  db.commit()
+
+# returns the digest (bytes) or None if the bulletin can not be deduplicated
+def bulletin_digest(data, fileheader=None) :
+  gtsheader = gts_from_heading(data)
+  if gtsheader is None :
+    gtsheader = fileheader
+  if gtsheader is None :
+    return None
+  bufr_list = bufr_message_list(data)
+  if len(bufr_list) == 0 :
+    return None
+  digest = hashlib.blake2b(digest_size=16)
+  heading = ' '.join([ gtsheader[key] for key in ["TT","AA","II","CCCC","YY","GG","gg","BBB"] ])
+  digest.update(heading.encode())
+  for (offset, length) in bufr_list :
+    digest.update(data[offset:offset+length])
+  return digest.digest()
+
+# the digests of all bulletins in a file: list of (offset, digest)
+# (see gts_bulletin_index, a file with 1 bulletin has offset 0)
+def bulletin_digests(data, fileheader=None) :
+  bulletins = gts_bulletin_index(data)
+  if len(bulletins) == 1 :
+    return [(0, bulletin_digest(data, fileheader))]
+  return [ (offset, bulletin_digest(data[offset:offset+length]))
+           for (offset, length, rawheader) in bulletins ]
+
+# for every file in the list: (digests, prefetched)
+#   digests: None if it is not deduplicated
+#   prefetched: what was read, for parse_gts_file (None if nothing)
+# The same quick rejections as in parse_gts_file are done first: files that
+# are rejected on their name are not read at all, on their raw heading only
+# the first bytes are read (and they are not deduplicated).
+# NOTE: the bytes of all files in the list are kept until they are parsed,
+# so it is called for 1 chunk at a time (see ingest_setup)
+def file_digests(gtsdir, file_list, mindate, maxdate, gfilter) :
+  result = []
+  for (filename, signature) in file_list :
+    fileheader = gts_from_filename(filename)
+    if fileheader is not None and gfilter['filename'] :
+      if gts_check(fileheader, mindate, maxdate, gfilter) is not None :
+        result.append((None, None))
         continue
-    # 3. now compare to the already existing obs
-      # first extract a smaller table 'gts' for the current GTS header
-      # TTAAII CCCC YYGGgg
-      select_gts = "CREATE TEMP VIEW gts as SELECT * FROM data WHERE \
-                  TT='%s' AND AA='%s' AND II='%s' \
-                  AND CCCC='%s' AND TIMESTAMP='%s' " % \
-                  tuple(flist['gtsheader'][i] for i in ['TT','AA','II','CCCC','TIMESTAMP'])
-
-      db.execute(select_gts)
-      db.commit()
+    prefetched = gts_read_checked(gts_file_path(gtsdir, filename), fileheader,
+                                  mindate, maxdate, gfilter)
+    if prefetched[0] is not None :
+      result.append((None, prefetched))
+    else :
+      result.append((bulletin_digests(prefetched[1], fileheader), prefetched))
+  return result
+
+# returns True if the cycle already has a bulletin with this digest
+# else the digest is added
+def sqlite_is_duplicate(db, digest, fullname) :
+  if digest is None :
+    return False
+  x1 = db.execute('SELECT filename FROM digests WHERE digest=?', (digest,)).fetchone()
+  if x1 is None :
+    db.execute('INSERT INTO digests (digest, filename) VALUES (?, ?)', (digest, fullname))
+    return False
+  db.execute('UPDATE digests SET duplicates=duplicates+1 WHERE digest=?', (digest,))
+  metrics_count('bulletins_duplicate')
+  return True
 
-      for i in range(flist['subcount']) :
-# COMPARE SPEED: find in dictionary or in SQLite
-#        z1 = db.executemany("SELECT * from gts WHERE key= ?", [(fsub['key'])])
-#        x1 = z1.fetchall()
-# BUG: [i] may not work if subcount=1?
-        z1 = db.execute(select_sid, flist['bufrlist'][i])
-        x1 = z1.fetchall()
-#        print 'i=%d len(x1)=%d' %(i,len(x1))
-        if len(x1) > 1 :
-           print_debug("ERROR: more than 1 instance for found")
-           return 1
-        if len(x1) > 0 :
-#          print_debug 'PRIORITY CHECK subset %d' % i
-          if not gts_priority(x1[0][1], flist['gtsheader']['BBB']) :
-            print_debug("REPLACING %d" % i)
-            allkeys = {'filename':fullname}
-            allkeys.update(flist['gtsheader'])
-            allkeys.update(flist['bufrlist'][i])
-            db.execute(replace_obs, allkeys)
+# digests: the result of file_digests for 1 file
+# returns None if all bulletins of the file are duplicates (skip the file)
+# else the set of offsets of the duplicate bulletins
+def sqlite_duplicate_bulletins(db, digests, fullname) :
+  if digests is None :
+    return set()
+  result = set([ offset for (offset, digest) in digests
+                 if sqlite_is_duplicate(db, digest, fullname) ])
+  if len(result) == len(digests) :
+    metrics_count('files_duplicate')
+    return None
+  return result
 
-        else :
-          print_debug("ADDING %d" % i)
-          allkeys = {'filename':fullname}
-          allkeys.update(flist['gtsheader'])
-          allkeys.update(flist['bufrlist'][i])
-          db.execute(write_obs, allkeys)
+# number of skipped copies for a cycle
+def sqlite_duplicate_count(db) :
+  return db.execute('SELECT coalesce(sum(duplicates), 0) FROM digests').fetchone()[0]
 
-      db.execute('DROP VIEW gts')
-      db.commit()
+##########################################################
+# multi-cycle ingestion: walk every GTS directory only once
+# Overlapping cycles (e.g. hourly cycles, or 3-hourly DA with wide windows)
+# mostly scan the same directories. Here, every new file is parsed once
+# (for the union of all time windows) and then added to all cycles for
+# which the file is new and whose obs_window() contains its gts_date().
+# The result for every cycle is the same as with update_sqlite().
+
+# all cycles from first to last (included), every cycle_step hours
+def cycle_schedule(first, last, cycle_step=1) :
+  result = []
+  current = first
+  while current <= last :
+    result.append(current)
+    current = current + dt.timedelta(hours=cycle_step)
+  return result
+
+# cycles: dictionary {cycle_date : (db, meta)}
+# returns a dictionary with the number of new files for every cycle
+def scan_gts_dirs_multi(cycles, GTS_path, ingest, verbose=True) :
+  nfiles = dict( (cycle_date, 0) for cycle_date in cycles )
+  if len(cycles) == 0 :
+    return nfiles
+  current = min( dt.datetime.strptime(cycles[c][1]['lastdir'], '%Y%m%d%H') for c in cycles )
+  while 1 :
+    newdir = current.strftime('%Y%m%d%H')
+    gtsdir = gts_dir_path(GTS_path, newdir)
+    current = current + dt.timedelta(hours=1)
+
+    # the cycles that still need this directory (see scan_gts_dirs)
+    active = [ c for c in sorted(cycles)
+               if cycles[c][1]['lastdir'] <= newdir and current <= c + dt.timedelta(hours=48) ]
+    if current > max(cycles) + dt.timedelta(hours=48) :
+      if verbose : print('Stopping GTS parsing at 48h after obs date')
+      break
+    if len(active) == 0 :
+      continue
+
+    if not os.path.exists(gtsdir) :
+      if current > dt.datetime.utcnow() :
+         if verbose : print("Directory " + newdir +" doesn't exist yet.")
+         break
+      else :
+         if verbose : print("Directory " + newdir +" doesn't exist.")
+         continue
+
+    if verbose : print("Scanning directory " + newdir + " for %i cycles" % len(active))
+    listing = None
+    todo = {}
+    for cycle_date in active :
+      (db, meta) = cycles[cycle_date]
+      db.execute("UPDATE meta SET lastdir=?",(newdir,))
+      meta['lastdir'] = newdir
+      # the directory is only listed once
+      if listing is None :
+        t0 = metrics_start()
+        listing = gts_dir_listing(gtsdir)
+        metrics_stop('io', t0)
+        metrics_count('files_listed', len(listing))
+      t0 = metrics_start()
+      todo[cycle_date] = set(sqlite_new_files(db, newdir, listing, is_gts_archive(gtsdir)))
+      metrics_stop('sqlite', t0)
+
+    # parse every file once, for the union of all time windows
+    file_list = sorted(set.union(*todo.values()))
+    metrics_count('files_new', len(file_list))
+    if verbose : print("... %i new files" % len(file_list))
+    mindate = min( cycles[c][1]['mindate'] for c in todo )
+    maxdate = max( cycles[c][1]['maxdate'] for c in todo )
+
+    # skip the copies of bulletins that a cycle already has
+    # (a file is only parsed if it is new for at least 1 cycle, and a bulletin
+    # of a bundled file only if it is new for at least 1 cycle)
+    skip_cycle = dict( (cycle_date, {}) for cycle_date in todo )
+    duplicates = dict( (cycle_date, 0) for cycle_date in todo )
+    # the files are read, checked and parsed in chunks (see ingest_setup)
+    for chunk in list_chunks(file_list, ingest['chunk']) :
+      skip_list = None
+      prefetch_list = None
+      if ingest['dedup'] :
+        digests = dict(zip(chunk, file_digests(gtsdir, chunk, mindate, maxdate,
+                                               ingest['gfilter'])))
+        t0 = metrics_start()
+        for cycle_date in todo :
+          db = cycles[cycle_date][0]
+          for fileinfo in chunk :
+            if fileinfo not in todo[cycle_date] :
+              continue
+            skip = sqlite_duplicate_bulletins(db, digests[fileinfo][0],
+                                              gts_file_path(gtsdir, fileinfo[0]))
+            if skip is None :
+              db.execute(insert_scanned, (newdir, fileinfo[0]) + fileinfo[1])
+              todo[cycle_date].discard(fileinfo)
+              nfiles[cycle_date] += 1
+              duplicates[cycle_date] += 1
+            else :
+              skip_cycle[cycle_date][fileinfo] = skip
+        metrics_stop('sqlite', t0)
+        chunk = [ fileinfo for fileinfo in chunk
+                  if any( fileinfo in todo[c] for c in todo ) ]
+        skip_list = [ set.intersection(*[ skip_cycle[c][fileinfo] for c in todo
+                                          if fileinfo in todo[c] ])
+                      for fileinfo in chunk ]
+        prefetch_list = [ digests[fileinfo][1] for fileinfo in chunk ]
+
+      full_list = [ gts_file_path(gtsdir, filename) for (filename, signature) in chunk ]
+      parsed = ingest_parse(ingest, full_list, mindate, maxdate, skip_list, prefetch_list)
+
+      # route to all cycles
+      for (fileinfo, fullname, batches) in zip(chunk, full_list, parsed) :
+        for cycle_date in todo :
+          if fileinfo not in todo[cycle_date] :
+            continue
+          (db, meta) = cycles[cycle_date]
+          skip = skip_cycle[cycle_date].get(fileinfo, set())
+          for flist in batches :
+            if flist.shared.get('bulletin') in skip :
+              continue
+            gdt = gts_date(flist['gtsheader'], meta['maxdate'])
+            if gdt is not None and gdt >= meta['mindate'] and gdt <= meta['maxdate'] :
+              gtsheader = dict(flist.gtsheader, TIMESTAMP=gdt.strftime('%Y%m%d-%H%M%S'))
+              index_add_obs(meta['index'], fullname, flist, gtsheader)
+          t0 = metrics_start()
+          db.execute(insert_scanned, (newdir, fileinfo[0]) + fileinfo[1])
+          nfiles[cycle_date] += 1
+          if ingest['commit_every'] is not None and nfiles[cycle_date] % ingest['commit_every'] == 0 :
+            index_commit(meta['index'])
+          metrics_stop('sqlite', t0)
+      ingest_commit_cache(ingest)
+    for cycle_date in todo :
+      if verbose and duplicates[cycle_date] > 0 :
+        print("... " + cycle_date.strftime('%Y%m%d%H%M') + ": %i duplicates skipped"
+              % duplicates[cycle_date])
+    t0 = metrics_start()
+    for cycle_date in todo :
+      (db, meta) = cycles[cycle_date]
+      index_commit(meta['index'])
+    metrics_stop('sqlite', t0)
+  return nfiles
+
+# update several cycle data bases in one pass
+# cycle_dates: list of cycles, e.g. cycle_schedule(first, last, 3)
+# the options are as for update_sqlite()
+def update_sqlite_multi(cycle_dates, SQL_path, GTS_path, obs_window_size=60, parse_cache=None, workers=1,
+                        filter_spec=None, commit_every=None, metrics_file=None, index='sqlite') :
+  if metrics_file is not None :
+    metrics_enable()
+  print('========================')
+  print('= SYNOP GTS monitor    =')
+  print('========================')
+  print('Writing GTS data for %i cycles to %s' % (len(cycle_dates), SQL_path))
+  begintime = dt.datetime.today().strftime("%Y%m%d %H:%M:%S")
+  cycles = {}
+  for cycle_date in cycle_dates :
+    cycles[cycle_date] = open_cycle_db(cycle_date, SQL_path, obs_window_size, index)
+  ingest = ingest_setup(parse_cache, workers, filter_spec, commit_every)
+  scan_gts_dirs_multi(cycles, GTS_path, ingest)
+  ingest_close(ingest)
+  for cycle_date in sorted(cycles) :
+    index_flush(cycles[cycle_date][1]['index'])
+    print('Duplicate bulletins skipped for ' + cycle_date.strftime('%Y%m%d%H%M') +
+          ': %i' % sqlite_duplicate_count(cycles[cycle_date][0]))
+    cycles[cycle_date][0].close()
+  if metrics_file is not None :
+    metrics_write(metrics_file, 'update_sqlite_multi')
+    metrics_disable()
+    print('Metrics written to ' + metrics_file + '.json')
   print('begin: '+begintime)
   print('end: '+dt.datetime.today().strftime("%Y%m%d %H:%M:%S"))
   print('= SQLITE FINISHED =')
 
+# the cycle data bases are written by a single process:
+# WAL journal and synchronous=NORMAL avoid most fsync's at every commit
+# (a crash may lose the last transaction, but never corrupts the data base)
+# NOTE: WAL does not work on network file systems, so keep SQL_path local
+def sqlite_tune(db) :
+  db.execute('PRAGMA journal_mode=WAL')
+  db.execute('PRAGMA synchronous=NORMAL')
+  # cache size in kB (if negative)
+  db.execute('PRAGMA cache_size=-65536')
+  db.execute('PRAGMA temp_store=MEMORY')
+
 def check_create_metatable(db, cycle_date, obs_window_size=60) :
   check_meta = "SELECT name FROM sqlite_master WHERE type='table' AND name='meta';"
   z1 = db.execute(check_meta)
@@ -444,75 +1851,478 @@ def check_create_metatable(db, cycle_date, obs_window_size=60) :
   result['maxdate'] = dt.datetime.strptime(result['maxdate'], "%Y-%m-%d %H:%M:%S")
   return result
 
+# Compact schema: the cycle data bases of several days are kept.
+#   files     : file_id, filename (full path, or archive::member)
+#   bulletins : bulletin_id, TT, AA, II, CCCC, TIMESTAMP (GTS header without BBB)
+#   obs       : 1 row per observation (subset), WITHOUT ROWID,
+#               key (bulletin_id, SID), BBB as an integer (see bbb_encode)
+#   data      : a view with the same columns as the old data table (read only)
+# Data bases of older versions are converted when they are opened.
+# Nothing is read here, so opening a large data base costs nothing.
 def check_create_datatable(db) :
   #keylist=["TT","AA","II","CCCC","YY","GG","gg","BBB"]
   # CONSIDER : TTAAII CCCC YYGGgg BBB
   # table names GG and gg are the same...
-  table_def_data = 'CREATE TABLE IF NOT EXISTS data ( \
-                    TT VARCHAR[2], AA VARCHAR[2], II VARCHAR[2], \
-                    CCCC VARCHAR[4],\
-                    TIMESTAMP VARCHAR[15],\
-                    BBB VARCHAR[3], \
-                    SID VARCHAR,\
-                    filename VARCHAR, subset INTEGER)'
-  db.execute(table_def_data)
+  x1 = db.execute("SELECT type FROM sqlite_master WHERE name='data'").fetchone()
+  if x1 is not None and x1[0] == 'table' :
+    migrate_datatable(db)
+    return
+  create_obs_tables(db)
   db.commit()
 
-  # now read data (?)
-  get_data = "SELECT * FROM data"
-  z2 = db.execute(get_data)
-  x2 = z2.fetchall()
-  if len(x2) > 0 :
-    colnames = list(zip(*z2.description))[0]
-    mykey = list(zip(*x2))[0]
-    result = dict((y,x) for x in x2[0] for y in mykey)
-  else :
-    result = None
-  return result
+def create_obs_tables(db) :
+  db.execute('CREATE TABLE IF NOT EXISTS files ( \
+                file_id INTEGER PRIMARY KEY, filename VARCHAR UNIQUE)')
+  db.execute('CREATE TABLE IF NOT EXISTS bulletins ( \
+                bulletin_id INTEGER PRIMARY KEY, \
+                TT VARCHAR[2], AA VARCHAR[2], II VARCHAR[2], CCCC VARCHAR[4], \
+                TIMESTAMP VARCHAR[15], \
+                UNIQUE (TT, AA, II, CCCC, TIMESTAMP))')
+  # every observation (subset) only once for a given GTS header
+  db.execute('CREATE TABLE IF NOT EXISTS obs ( \
+                bulletin_id INTEGER, SID VARCHAR, BBB INTEGER, file_id INTEGER, \
+                subset INTEGER, nsubsets INTEGER, msgoffset INTEGER, msglength INTEGER, \
+                PRIMARY KEY (bulletin_id, SID)) WITHOUT ROWID')
+  db.execute('CREATE VIEW IF NOT EXISTS data AS \
+                SELECT TT, AA, II, CCCC, TIMESTAMP, ' + bbb_decode_sql + ' AS BBB, SID, \
+                  filename, subset, nsubsets, msgoffset, msglength \
+                FROM obs JOIN bulletins USING (bulletin_id) JOIN files USING (file_id)')
+
+# an old data table (all strings in every row) is converted in place
+# and the file is vacuumed, so it really becomes smaller
+def migrate_datatable(db) :
+  print('Converting the data table to the compact schema')
+  upgrade_datatable(db)
+  db.execute('ALTER TABLE data RENAME TO data_old')
+  create_obs_tables(db)
+  db.create_function('bbb_encode', 1, bbb_encode)
+  db.execute('INSERT OR IGNORE INTO files (filename) \
+                SELECT filename FROM data_old ORDER BY rowid')
+  db.execute('INSERT OR IGNORE INTO bulletins (TT, AA, II, CCCC, TIMESTAMP) \
+                SELECT TT, AA, II, CCCC, TIMESTAMP FROM data_old ORDER BY rowid')
+  db.execute('INSERT OR IGNORE INTO obs \
+                SELECT bulletin_id, SID, bbb_encode(BBB), file_id, \
+                  subset, nsubsets, msgoffset, msglength \
+                FROM data_old JOIN bulletins USING (TT, AA, II, CCCC, TIMESTAMP) \
+                  JOIN files USING (filename)')
+  db.execute('DROP TABLE data_old')
+  check_create_writtentable(db)
+  db.execute('VACUUM')
+
+# data bases from older versions have no message position columns
+# (the old rows just keep NULL and are decoded at output time)
+def upgrade_datatable(db) :
+  columns = [ x[1] for x in db.execute('PRAGMA table_info(data)') ]
+  for col in ['nsubsets', 'msgoffset', 'msglength'] :
+    if col not in columns :
+      db.execute('ALTER TABLE data ADD COLUMN %s INTEGER' % col)
+
+# convert all cycle data bases in a directory (e.g. the archive of the last days)
+def migrate_sqlite_files(SQL_path) :
+  for filename in sorted(os.listdir(SQL_path)) :
+    if filename.startswith('synop_') and filename.endswith('.sqlite') :
+      print('Checking ' + filename)
+      db = sqlite3.connect(os.path.join(SQL_path, filename))
+      check_create_datatable(db)
+      db.close()
 
 ##########################################################
 # to be run regularly: clean up old messages in SQLite file
 def cleanup_sqlite(filename, mindate) :
   # remove all entries prior to mindate
-  table_remove_old = "DELETE FROM data \
-                      WHERE TIMESTAMP < '%s'"
-  
-  db.execute(table_remove_old)
+  db = sqlite3.connect(filename)
+  db.execute('DELETE FROM obs WHERE bulletin_id IN \
+                (SELECT bulletin_id FROM bulletins WHERE TIMESTAMP < ?)',
+             (mindate.strftime('%Y%m%d-%H%M%S'),))
+  db.execute('DELETE FROM bulletins WHERE bulletin_id NOT IN (SELECT bulletin_id FROM obs)')
+  db.execute('DELETE FROM files WHERE file_id NOT IN (SELECT file_id FROM obs)')
   db.commit()
+  db.close()
 
 ##########################################################
 # to be run for every required data set
-def bufr_extract(filename, subsetnr, outfile) :
-  if not os.path.exists(filename) :
-    print('input file does not exist: ' + filename)
+# msgpos: (msgoffset, msglength) of the BUFR message in the file, as in the
+#   data table: only this message is read (e.g. 1 bulletin of a bundled file)
+#   default is the first BUFR message in the file
+def bufr_extract(filename, subsetnr, outfile, msgpos=None) :
+  return bufr_extract_subsets(filename, [subsetnr], outfile, msgpos)
+
+# extract several subsets from the same file
+# every subset is written as a separate BUFR message
+def bufr_extract_subsets(filename, subsetlist, outfile, msgpos=None) :
+  msglist = bufr_extract_messages(filename, subsetlist, msgpos)
+  if msglist is None :
     return 1
-  f1 = open(filename)
-  bmsg = codes_bufr_new_from_file(f1)
+  for msg in msglist :
+    if msg is not None :
+      outfile.write(msg)
+
+# the file is read, decoded and unpacked only once
+# returns a list with the BUFR message (bytes) for every subset (None if it failed)
+def bufr_extract_messages(filename, subsetlist, msgpos=None) :
+  filename = gts_resolve_file(filename)
+  if not gts_file_exists(filename) :
+    print('input file does not exist: ' + filename)
+    return None
+  if msgpos is not None and msgpos[0] is not None :
+    data = read_raw_message(filename, msgpos[0], msgpos[1])
+  else :
+    data = read_gts_file(filename)
+  bufr_list = bufr_message_list(data)
+  if len(bufr_list) == 0 :
+    print('no BUFR message found: ' + filename)
+    return None
+  (offset, length) = bufr_list[0]
+  bmsg = codes_new_from_message(data[offset:offset+length])
 
 #  print "%s %d" %(filename,subsetnr)
 
   subset_count = codes_get(bmsg, "numberOfSubsets")
-  if subsetnr > subset_count :
-    print('subset number too big')
-    return 1
-  codes_set(bmsg, 'unpack', 1)
-  try :
-    if subset_count > 1 :
-      codes_set(bmsg, "extractSubset", subsetnr)
-      codes_set(bmsg,'doExtractSubsets',1)
-      bmsg2 = codes_clone(bmsg)
-      codes_write(bmsg2, outfile)
-      codes_release(bmsg2)
-    else :
-      codes_write(bmsg, outfile)
-  except CodesInternalError as err :
-    print('I tried but failed: \n   '+filename)
-    sys.stderr.write(err.msg + '\n')
+  # a single subset can be written as it is
+  if subset_count > 1 :
+    codes_set(bmsg, 'unpack', 1)
+  result = []
+  for subsetnr in subsetlist :
+    if subsetnr > subset_count :
+      print('subset number too big')
+      result.append(None)
+      continue
+    try :
+      if subset_count > 1 :
+        # the unpacked data stays available, so we can extract one subset after the other
+        codes_set(bmsg, "extractSubset", subsetnr)
+        codes_set(bmsg,'doExtractSubsets',1)
+        bmsg2 = codes_clone(bmsg)
+        result.append(codes_get_message(bmsg2))
+        codes_release(bmsg2)
+      else :
+        result.append(codes_get_message(bmsg))
+    except CodesInternalError as err :
+      print('I tried but failed: \n   '+filename)
+      sys.stderr.write(err.msg + '\n')
+      result.append(None)
  
   codes_release(bmsg)
-  f1.close()
+  return result
+
+# Copy a BUFR message from a GTS file without decoding it.
+# Inside the kernel if possible (copy_file_range, sendfile), else pread/write.
+def copy_raw_message(outfd, filename, offset, length) :
+  infd = os.open(filename, os.O_RDONLY)
+  try :
+    while length > 0 :
+      try :
+        n = os.copy_file_range(infd, outfd, length, offset)
+      except (AttributeError, OSError) :
+        try :
+          n = os.sendfile(outfd, infd, offset, length)
+        except (AttributeError, OSError) :
+          n = os.write(outfd, os.pread(infd, length, offset))
+      if n == 0 :
+        raise IOError('unexpected end of file: ' + filename)
+      offset += n
+      length -= n
+  finally :
+    os.close(infd)
+
+# read a BUFR message (without decoding) from its position in a GTS file
+def read_raw_message(filename, offset, length) :
+  if split_archive_name(filename)[1] is not None :
+    return read_gts_file(filename)[offset:offset+length]
+  infd = os.open(filename, os.O_RDONLY)
+  try :
+    return os.pread(infd, length, offset)
+  finally :
+    os.close(infd)
 
-def bufr_make_output(cycle_date, SQL_path, BUFR_path) :
+##########################################################
+# repacking: single subset messages with the same descriptor template are
+# merged into multi-subset messages (optionally with BUFR compression)
+# The template is given by the header keys, the descriptors, the delayed
+# replication factors and the list of data keys.
+repack_header_keys = ['edition', 'masterTableNumber', 'bufrHeaderCentre',
+                      'bufrHeaderSubCentre', 'dataCategory',
+                      'internationalDataSubCategory', 'dataSubCategory',
+                      'masterTablesVersionNumber', 'localTablesVersionNumber']
+# the replication factors can not be set as data, they must be known
+# before the descriptors are expanded
+repack_replication_keys = {
+    'delayedDescriptorReplicationFactor' : 'inputDelayedDescriptorReplicationFactor',
+    'shortDelayedDescriptorReplicationFactor' : 'inputShortDelayedDescriptorReplicationFactor',
+    'extendedDelayedDescriptorReplicationFactor' : 'inputExtendedDelayedDescriptorReplicationFactor'}
+
+# decode a single subset message
+# returns (template, data keys, values) or None if it can not be repacked
+def bufr_subset_values(msg) :
+  bmsg = None
+  try :
+    bmsg = codes_new_from_message(msg)
+    if codes_get(bmsg, 'numberOfSubsets') != 1 :
+      codes_release(bmsg)
+      return None
+    codes_set(bmsg, 'skipExtraKeyAttributes', 1)
+    codes_set(bmsg, 'unpack', 1)
+    template = [ codes_get(bmsg, key) for key in repack_header_keys ]
+    template.append(tuple(codes_get_array(bmsg, 'unexpandedDescriptors')))
+    template.append(tuple(codes_get_array(bmsg, 'expandedDescriptors')))
+    for key in repack_replication_keys :
+      if codes_is_defined(bmsg, key) :
+        template.append((key, tuple(codes_get_array(bmsg, key))))
+    keys = []
+    started = False
+    iterid = codes_bufr_keys_iterator_new(bmsg)
+    while codes_bufr_keys_iterator_next(iterid) :
+      key = codes_bufr_keys_iterator_get_name(iterid)
+      if key == 'unexpandedDescriptors' :
+        started = True
+        continue
+      # subsetNumber is only there for uncompressed data, and it is read-only
+      if started and key != 'subsetNumber' and '->' not in key :
+        keys.append(key)
+    codes_bufr_keys_iterator_delete(iterid)
+    values = [ codes_get(bmsg, key) for key in keys ]
+    codes_release(bmsg)
+  except CodesInternalError as err :
+    print_debug('... can not decode message for repacking')
+    if bmsg is not None : codes_release(bmsg)
+    return None
+  template.append(tuple(keys))
+  return (tuple(template), keys, values)
+
+# merge a list of single subset messages with the same template
+# decoded: list of (template, keys, values), as returned by bufr_subset_values
+def bufr_repack_messages(msglist, decoded, compressed=False) :
+  nsub = len(msglist)
+  keys = decoded[0][1]
+  bmsg = codes_new_from_message(msglist[0])
+  try :
+    codes_set(bmsg, 'skipExtraKeyAttributes', 1)
+    codes_set(bmsg, 'unpack', 1)
+    unexpanded = codes_get_array(bmsg, 'unexpandedDescriptors')
+    replication = {}
+    for key in repack_replication_keys :
+      if codes_is_defined(bmsg, key) :
+        replication[key] = codes_get_array(bmsg, key)
+    codes_set(bmsg, 'numberOfSubsets', nsub)
+    codes_set(bmsg, 'compressedData', 1 if compressed else 0)
+    for key in replication :
+      rep = list(replication[key])
+      # uncompressed: the factors are given for every subset
+      if not compressed : rep = rep * nsub
+      codes_set_array(bmsg, repack_replication_keys[key], rep)
+    codes_set_array(bmsg, 'unexpandedDescriptors', unexpanded)
+
+    # "#rank#key" : in an uncompressed message the rank continues over
+    # the subsets, in a compressed message there is an array per key
+    maxrank = {}
+    for key in keys :
+      (rank, name) = key[1:].split('#', 1)
+      maxrank[name] = max(maxrank.get(name, 0), int(rank))
+    for k in range(len(keys)) :
+      (rank, name) = keys[k][1:].split('#', 1)
+      if name in repack_replication_keys : continue
+      values = [ x[2][k] for x in decoded ]
+      if compressed :
+        if isinstance(values[0], str) :
+          codes_set_string_array(bmsg, keys[k], values)
+        else :
+          codes_set_array(bmsg, keys[k], values)
+      else :
+        for i in range(nsub) :
+          codes_set(bmsg, '#%i#%s' % (i * maxrank[name] + int(rank), name), values[i])
+    codes_set(bmsg, 'pack', 1)
+    result = codes_get_message(bmsg)
+  finally :
+    codes_release(bmsg)
+  return result
+
+# msglist: list of (msglist, decoded), all with the same template
+# if repacking fails, the original messages are returned
+def repack_worker(args) :
+  (msglist, decoded, compressed) = args
+  if len(msglist) == 1 :
+    return msglist
+  try :
+    return [bufr_repack_messages(msglist, decoded, compressed)]
+  except CodesInternalError as err :
+    print('repacking failed, writing %i single messages' % len(msglist))
+    return msglist
+
+# msglist: list of BUFR messages (bytes), in output order
+# mapper: map function (e.g. from a multiprocessing pool)
+# The messages of a group stay in the original order, the groups are
+# ordered by their first message, so the result is still deterministic.
+def bufr_repack(msglist, compressed=False, max_subsets=100, mapper=map) :
+  decoded = list(mapper(bufr_subset_values, msglist))
+  groups = {}
+  tasks = []
+  for i in range(len(msglist)) :
+    if decoded[i] is None :
+      # can not be repacked, keep as it is
+      tasks.append([[msglist[i]], None, compressed])
+      continue
+    template = decoded[i][0]
+    if template not in groups or len(tasks[groups[template]][0]) >= max_subsets :
+      groups[template] = len(tasks)
+      tasks.append([[], [], compressed])
+    task = tasks[groups[template]]
+    task[0].append(msglist[i])
+    task[1].append(decoded[i])
+  result = []
+  for repacked in mapper(repack_worker, tasks) :
+    result.extend(repacked)
+  return result
+
+# extract all rows for 1 source file
+# rows: list of (sortkey, subset, nsubsets, msgoffset, msglength)
+# returns a list of (sortkey, BUFR message)
+# A single subset message is not decoded at all: the "message" is then just
+# its position (filename, offset, length) and it is copied when writing
+# (from an archive, the bytes are read right away).
+# The other messages are decoded once each (a bundled file has several).
+def extract_worker(args) :
+  (filename, rows) = args
+  filename = gts_resolve_file(filename)
+  result = []
+  decode = []
+  archived = split_archive_name(filename)[1] is not None
+  try :
+    fsize = gts_file_size(filename)
+  except (OSError, KeyError) :
+    fsize = 0
+  for row in rows :
+    (sortkey, subset, nsubsets, msgoffset, msglength) = row
+    if nsubsets == 1 and msgoffset is not None and msgoffset + msglength <= fsize :
+      if archived :
+        result.append((sortkey, read_raw_message(filename, msgoffset, msglength)))
+      else :
+        result.append((sortkey, (filename, msgoffset, msglength)))
+    else :
+      decode.append(row)
+  decode.sort(key=lambda x: (x[3] is not None, x[3], x[4]))
+  for (msgpos, group) in itertools.groupby(decode, key=lambda x: (x[3], x[4])) :
+    group = list(group)
+    msglist = bufr_extract_messages(filename, [ x[1] for x in group ], msgpos)
+    if msglist is not None :
+      result.extend([ (group[i][0], msglist[i]) for i in range(len(group))
+                      if msglist[i] is not None ])
+  return result
+
+# msglist: list of (sortkey, message), the message is either bytes or the
+#   position (filename, offset, length) of a message that is copied as it is
+# The file is written under a temporary name and renamed at the end.
+# returns the number of messages that were copied without decoding
+def bufr_write_messages(msglist, outfile) :
+  # unbuffered, because raw copies and decoded messages are mixed
+  tmpfile = outfile + '.tmp%i' % os.getpid()
+  outfd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  rawcount = 0
+  for (sortkey, msg) in msglist :
+    if isinstance(msg, tuple) :
+      copy_raw_message(outfd, *msg)
+      rawcount += 1
+    else :
+      os.write(outfd, msg)
+  os.fsync(outfd)
+  os.close(outfd)
+  os.replace(tmpfile, outfile)
+  return rawcount
+
+##########################################################
+# incremental output
+# Every cycle data base keeps the rows that are in the BUFR output file
+# (table written): the bulletin and SID, BBB, source file and subset (all as
+# in table obs), and the position of the message in the output file.
+# A row that did not change since then is copied from the previous output,
+# only the new and corrected rows are extracted. So an update after a few late
+# (or corrected) bulletins costs time proportional to the changes.
+# The state is only used if the output file is still the one we wrote
+# (table output_state: size and mtime), else everything is extracted again.
+# Only the state of the last output file is kept (e.g. not for a copy in
+# another BUFR_path).
+def check_create_writtentable(db) :
+  table_def_output_state = 'CREATE TABLE IF NOT EXISTS output_state ( \
+                            outfile VARCHAR PRIMARY KEY, size INTEGER, mtime INTEGER, \
+                            deltas INTEGER)'
+  db.execute(table_def_output_state)
+  # before the compact schema: everything is extracted once more
+  columns = [ x[1] for x in db.execute('PRAGMA table_info(written)') ]
+  if 'filename' in columns :
+    db.execute('DROP TABLE written')
+    db.execute('UPDATE output_state SET size=NULL, mtime=NULL')
+  table_def_written = 'CREATE TABLE IF NOT EXISTS written ( \
+                       bulletin_id INTEGER, SID VARCHAR, BBB INTEGER, file_id INTEGER, \
+                       subset INTEGER, outoffset INTEGER, outlength INTEGER, \
+                       PRIMARY KEY (bulletin_id, SID)) WITHOUT ROWID'
+  db.execute(table_def_written)
+  db.commit()
+
+# the rows in the current output file:
+#   {(bulletin_id, SID) : (BBB, file_id, subset, outoffset, outlength)}
+# and the number of delta files so far
+# (no rows if the output file is missing or was changed by someone else)
+def sqlite_written_rows(db, outfile, with_rows=True) :
+  x1 = db.execute('SELECT size, mtime, deltas FROM output_state WHERE outfile=?',
+                  (outfile,)).fetchone()
+  if x1 is None :
+    return ({}, 0)
+  if not with_rows or x1[0] is None :
+    return ({}, x1[2])
+  if not os.path.exists(outfile) or file_signature(outfile) != (x1[0], x1[1]) :
+    print('Output file was changed, extracting everything again')
+    return ({}, x1[2])
+  z1 = db.execute('SELECT bulletin_id, SID, BBB, file_id, subset, \
+                     outoffset, outlength FROM written')
+  return (dict( (x[0:2], x[2:7]) for x in z1 ), x1[2])
+
+# msglist: the (sorted) list that was written to outfile
+# rows: {sortkey : (BBB, file_id, subset, bulletin_id, SID)}
+def sqlite_set_written(db, outfile, msglist, rows, deltas) :
+  db.execute('DELETE FROM written')
+  written = []
+  offset = 0
+  for (sortkey, msg) in msglist :
+    length = msg[2] if isinstance(msg, tuple) else len(msg)
+    row = rows[sortkey]
+    written.append(row[3:5] + row[0:3] + (offset, length))
+    offset += length
+  db.executemany('INSERT INTO written VALUES (?, ?, ?, ?, ?, ?, ?)', written)
+  db.execute('DELETE FROM output_state')
+  db.execute('INSERT INTO output_state VALUES (?, ?, ?, ?)',
+             (outfile,) + file_signature(outfile) + (deltas,))
+  db.commit()
+
+# nothing can be re-used after repacking
+def sqlite_clear_written(db, outfile, deltas) :
+  db.execute('DELETE FROM written')
+  db.execute('DELETE FROM output_state')
+  db.execute('INSERT INTO output_state VALUES (?, NULL, NULL, ?)', (outfile, deltas))
+  db.commit()
+
+# the delta files are numbered: synop_YYYYMMDDHHMM_delta01.BUFR, ...
+def delta_filename(cycle_date, BUFR_path, number) :
+  filename = os.path.join(BUFR_path, 'synop_' + cycle_date.strftime('%Y%m%d%H%M') +
+                          '_delta%02i.BUFR' % number)
+  return filename
+
+# workers: number of parallel extraction processes
+# The output is always sorted by (SID, TIMESTAMP, TT, AA, II, CCCC), so it does not
+# depend on the number of workers. It is written to a temporary file that is
+# renamed at the end, so nobody ever reads a half-written output file.
+# repack: merge the subsets into multi-subset messages (at most max_subsets
+#   per message), with BUFR compression if compress=True
+# metrics_file: write metrics to metrics_file.json and metrics_file.prom
+#   (the decode time is the wall time of the extraction, also with workers)
+# incremental: only extract the rows that are not yet in the output file
+#   (the output file is then the same as without, see check_create_writtentable)
+#   not with repack: then everything is extracted every time
+# delta: also write a delta file, with only the new and corrected observations
+#   since the previous output (see delta_filename)
+def bufr_make_output(cycle_date, SQL_path, BUFR_path, workers=1, repack=False,
+                     compress=False, max_subsets=100, metrics_file=None,
+                     incremental=True, delta=False) :
+  if metrics_file is not None :
+    metrics_enable()
   sqlitefile = sqlite_filename(cycle_date, SQL_path)
   print('========================')
   print('= SYNOP BUFR extractor =')
@@ -524,27 +2334,401 @@ def bufr_make_output(cycle_date, SQL_path, BUFR_path) :
     return 1
 
   db = sqlite3.connect(sqlitefile)
+  check_create_datatable(db)
+  check_create_writtentable(db)
   outfile = output_filename(cycle_date, BUFR_path)
-# TODO
-  bufrfile = open(outfile, "ab")
   print('Writing BUFR messages to '+outfile)
-
-  alldata = db.execute('SELECT * from data')
-  msgcount = 0
-  while 1 :
-    nextcase = alldata.fetchone()
-    if nextcase is None :
-      break
-    msgcount = msgcount + 1
-#    print "message %d" % msgcount
-    # this return a tuple, so we must know the column numbers
-    (filename, subset) = (nextcase[7], nextcase[8])
-    bufr_extract(filename, subset, bufrfile)
-
-  bufrfile.close()
-  print('extracted %i BUFR messages' % msgcount)
+  incremental = incremental and not repack
+  (previous, deltas) = sqlite_written_rows(db, outfile, incremental)
+
+  # sorted by file, so every file is decoded only once for all its subsets
+  t0 = metrics_start()
+  alldata = db.execute('SELECT filename, subset, SID, TIMESTAMP, TT, AA, II, CCCC, \
+                          nsubsets, msgoffset, msglength, BBB, bulletin_id, file_id \
+                        FROM obs JOIN bulletins USING (bulletin_id) JOIN files USING (file_id) \
+                        ORDER BY file_id, subset')
+  tasks = []
+  rows = {}
+  reused = []
+  for (filename, group) in itertools.groupby(alldata, key=lambda x: x[0]) :
+    todo = []
+    for x in group :
+      sortkey = x[2:8]
+      rows[sortkey] = (x[11], x[13], x[1], x[12], x[2])
+      old = previous.get((x[12], x[2]))
+      if old is not None and old[0:3] == rows[sortkey][0:3] :
+        # the same message is in the output file already
+        reused.append((sortkey, (outfile, old[3], old[4])))
+      else :
+        todo.append((sortkey, x[1], x[8], x[9], x[10]))
+    if len(todo) > 0 :
+      tasks.append((filename, todo))
+  metrics_stop('sqlite', t0)
+  metrics_count('files_selected', len(tasks))
+  metrics_count('subsets_selected', sum([ len(x[1]) for x in tasks ]))
+  if incremental and len(previous) > 0 :
+    print('%i messages already written, %i new or corrected' %
+          (len(reused), sum([ len(x[1]) for x in tasks ])))
+    if len(tasks) == 0 and len(reused) == len(previous) :
+      print('Output is up to date')
+      db.close()
+      if metrics_file is not None :
+        metrics_write(metrics_file, 'bufr_make_output')
+        metrics_disable()
+      print('= BUFR FINISHED =')
+      return
+
+  t0 = metrics_start()
+  if workers > 1 and len(tasks) > 1 :
+    print('Extracting with %i worker processes' % workers)
+    archive_prepare([ x[0] for x in tasks ])
+    pool = multiprocessing.Pool(workers)
+    extracted = pool.imap_unordered(extract_worker, tasks, chunksize=8)
+  else :
+    pool = None
+    extracted = map(extract_worker, tasks)
+  msglist = []
+  for result in extracted :
+    msglist.extend(result)
+  msglist.sort()
+  archive_close()
+  changed = msglist
+  msglist = sorted(reused + changed)
+  missing = sum([ len(x[1]) for x in tasks ]) - len(changed)
+  metrics_count('subsets_missing', missing)
+  if missing > 0 :
+    print('WARNING: %i observations could not be extracted' % missing)
+
+  if repack :
+    msglist = [ read_raw_message(*msg) if isinstance(msg, tuple) else msg
+                for (sortkey, msg) in msglist ]
+    nsubsets = len(msglist)
+    if pool is not None :
+      mapper = lambda func, args : pool.imap(func, args, chunksize=8)
+    else :
+      mapper = map
+    msglist = [ (None, msg) for msg in
+                bufr_repack(msglist, compress, max_subsets, mapper) ]
+    print('repacked %i subsets into %i messages' % (nsubsets, len(msglist)))
+  if pool is not None :
+    pool.close()
+    pool.join()
+  metrics_stop('decode', t0)
+
+  t0 = metrics_start()
+  if delta :
+    # before the output file is replaced: the reused messages are copied from it
+    deltas += 1
+    deltafile = delta_filename(cycle_date, BUFR_path, deltas)
+    bufr_write_messages(changed, deltafile)
+    print('Writing %i new or corrected messages to %s' % (len(changed), deltafile))
+  rawcount = bufr_write_messages(msglist, outfile)
+  metrics_stop('io', t0)
+  t0 = metrics_start()
+  if incremental :
+    sqlite_set_written(db, outfile, msglist, rows, deltas)
+  else :
+    sqlite_clear_written(db, outfile, deltas)
+  db.close()
+  metrics_stop('sqlite', t0)
+
+  msgcount = len(msglist)
+  metrics_count('messages_written', msgcount)
+  metrics_count('messages_copied', rawcount)
+  metrics_count('messages_reused', len(reused))
+  print('extracted %i BUFR messages (%i copied without decoding)' % (msgcount, rawcount))
+  if metrics_file is not None :
+    metrics_write(metrics_file, 'bufr_make_output')
+    metrics_disable()
+    print('Metrics written to ' + metrics_file + '.json')
   print('begin: '+begintime)
   print('end: '+dt.datetime.today().strftime("%Y%m%d %H:%M:%S"))
   print('= BUFR FINISHED =')
 
+##########################################################
+# streaming API: the same steps as update_sqlite() and bufr_make_output(),
+# but as generators that can be combined freely, e.g.
+#   (mindate, maxdate) = obs_window(cycle_date, 30)
+#   files = iter_gts_files(GTS_path, mindate, maxdate + dt.timedelta(hours=48))
+#   obs = iter_deduplicated(iter_observations(iter_parsed(files, mindate, maxdate)))
+#   sink_bufr(obs, 'synop.BUFR')    # or sink_sqlite(db, obs), or your own loop
+# Nothing is listed or parsed in advance, so the memory does not depend on the
+# size of the spool. Only iter_deduplicated() and sink_bufr() keep 1 small
+# entry per observation (that can not be avoided: a correction may still come).
+# An observation is a tuple with the values of obs_columns.
+
+# all existing hourly directories "YYYYMMDDHH" (or archives, see gts_dir_path)
+# from first to last (datetime), the directories that do not exist (yet) are skipped
+def iter_gts_dirs(GTS_path, first, last) :
+  current = first.replace(minute=0, second=0, microsecond=0)
+  while current <= last :
+    gtsdir = gts_dir_path(GTS_path, current.strftime('%Y%m%d%H'))
+    if os.path.exists(gtsdir) :
+      yield gtsdir
+    current = current + dt.timedelta(hours=1)
 
+# all files in these directories (in directory order, not sorted)
+def iter_gts_files(GTS_path, first, last) :
+  for gtsdir in iter_gts_dirs(GTS_path, first, last) :
+    if is_gts_archive(gtsdir) :
+      for (filename, signature) in archive_listing(gtsdir) :
+        yield gts_file_path(gtsdir, filename)
+      continue
+    for entry in os.scandir(gtsdir) :
+      if entry.is_file() :
+        yield entry.path
+
+# parse_gts_file() for every file, returns (fullname, SubsetBatch) for the accepted
+# bulletins (a bundled file can give several)
+# ingest: see ingest_setup() (parse cache, workers, filter), default is serial
+# with workers, the files are handed out in chunks of chunksize, so also then
+# the memory stays bounded (Pool.imap would read the whole input at once)
+def iter_parsed(files, mindate, maxdate, ingest=None, chunksize=1000) :
+  own_ingest = ingest is None
+  if own_ingest :
+    ingest = ingest_setup()
+  try :
+    files = iter(files)
+    while True :
+      chunk = list(itertools.islice(files, chunksize))
+      if len(chunk) == 0 :
+        break
+      for (fullname, batches) in zip(chunk, ingest_parse(ingest, chunk, mindate, maxdate)) :
+        for batch in batches :
+          yield (fullname, batch)
+      ingest_commit_cache(ingest)
+  finally :
+    if own_ingest :
+      ingest_close(ingest)
+
+# one observation per subset
+def iter_observations(parsed) :
+  for (fullname, batch) in parsed :
+    for obs in batch.rows(obs_columns, {'filename':fullname}) :
+      yield obs
+
+# the key of an observation: TT, AA, II, CCCC, TIMESTAMP, SID
+def obs_key(obs) :
+  return obs[0:5] + (obs[6],)
+
+# only the observations that are new, or that have priority over the one
+# with the same key that was seen before (see gts_priority)
+# this is what the upsert in sqlite_add_obs() does
+def iter_deduplicated(observations) :
+  seen = {}
+  for obs in observations :
+    key = obs_key(obs)
+    BBB = seen.get(key)
+    if BBB is None or not gts_priority(BBB, obs[5]) :
+      seen[key] = obs[5]
+      yield obs
+
+# write the observations to a cycle data base (see open_cycle_db)
+def sink_sqlite(db, observations, commit_every=None) :
+  observations = iter(observations)
+  while True :
+    chunk = list(itertools.islice(observations, commit_every or 10000))
+    if len(chunk) == 0 :
+      break
+    db.executemany(upsert_obs, sqlite_obs_rows(db, chunk))
+    if commit_every is not None :
+      db.commit()
+  db.commit()
+
+# write the observations to a BUFR file, like bufr_make_output()
+# if an observation comes more than once, the last one is written
+# (after iter_deduplicated() this is the one with the highest priority)
+# returns the number of BUFR messages
+def sink_bufr(observations, outfile, workers=1) :
+  final = {}
+  for obs in observations :
+    final[obs_key(obs)] = obs
+  # every file is decoded only once
+  tasks = []
+  allobs = sorted(final.values(), key=lambda x: (x[7], x[8]))
+  final = None
+  for (filename, rows) in itertools.groupby(allobs, key=lambda x: x[7]) :
+    tasks.append((filename, [ ((x[6], x[4]) + x[0:4], x[8], x[9], x[10], x[11])
+                              for x in rows ]))
+  allobs = None
+  if workers > 1 and len(tasks) > 1 :
+    archive_prepare([ x[0] for x in tasks ])
+    pool = multiprocessing.Pool(workers)
+    extracted = pool.imap_unordered(extract_worker, tasks, chunksize=8)
+  else :
+    pool = None
+    extracted = map(extract_worker, tasks)
+  msglist = []
+  for result in extracted :
+    msglist.extend(result)
+  if pool is not None :
+    pool.close()
+    pool.join()
+  archive_close()
+  msglist.sort()
+  bufr_write_messages(msglist, outfile)
+  return len(msglist)
+
+##########################################################
+# daemon mode: continuous monitoring instead of cron
+# All open cycles are kept in memory, new files are ingested as soon as they
+# arrive (inotify, or polling if that is not available) and the BUFR output
+# is written at fixed cutoff times.
+# All state is in the cycle data bases (meta.lastdir, scanned files, outputs),
+# so the daemon can be stopped and restarted at any time.
+
+# minimal inotify interface (Linux), so we need no extra python modules
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+def inotify_open() :
+  try :
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+  except (OSError, AttributeError) :
+    return None
+  if fd < 0 :
+    return None
+  return {'libc' : libc, 'fd' : fd, 'watches' : {}}
+
+# only watch the given directories (e.g. GTS_path and the latest hourly directories)
+def inotify_set_watches(notify, pathlist) :
+  for path in list(notify['watches']) :
+    if path not in pathlist :
+      notify['libc'].inotify_rm_watch(notify['fd'], notify['watches'].pop(path))
+  for path in pathlist :
+    if path in notify['watches'] or not os.path.isdir(path) :
+      continue
+    wd = notify['libc'].inotify_add_watch(notify['fd'], os.fsencode(path),
+                                          IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+    if wd >= 0 :
+      notify['watches'][path] = wd
+
+# wait for events: return True if anything happened before the timeout
+# we don't need the details: every wake-up means an (incremental) scan
+def inotify_wait(notify, timeout) :
+  (ready, x1, x2) = select.select([notify['fd']], [], [], timeout)
+  if len(ready) == 0 :
+    return False
+  try :
+    while len(os.read(notify['fd'], 65536)) > 0 : pass
+  except BlockingIOError :
+    pass
+  return True
+
+def inotify_close(notify) :
+  os.close(notify['fd'])
+
+# all cycles that may receive new observations at time "now"
+# i.e. the obs window has started, and we are not yet 48h after the obs date
+def open_cycles(now, cycle_step=1, obs_window_size=60) :
+  first = now - dt.timedelta(hours=48)
+  first = first.replace(hour=first.hour - first.hour % cycle_step, minute=0, second=0, microsecond=0)
+  last = now + dt.timedelta(minutes=obs_window_size/2)
+  result = []
+  current = first + dt.timedelta(hours=cycle_step)
+  while current <= last :
+    result.append(current)
+    current = current + dt.timedelta(hours=cycle_step)
+  return result
+
+# keep track of the BUFR outputs that are done (for every cutoff)
+def check_create_outputtable(db) :
+  table_def_outputs = 'CREATE TABLE IF NOT EXISTS outputs ( \
+                       cutoff INTEGER PRIMARY KEY, written datetime)'
+  db.execute(table_def_outputs)
+  db.commit()
+
+def output_done(db, cutoff) :
+  z1 = db.execute("SELECT written FROM outputs WHERE cutoff=?", (cutoff,))
+  return z1.fetchone() is not None
+
+def output_mark(db, cutoff) :
+  db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?)", (cutoff, dt.datetime.utcnow()))
+  db.commit()
+
+def monitor_stop(signum, frame) :
+  raise SystemExit('signal %i' % signum)
+
+# cycle_step: hours between cycles (aligned on 00 UTC)
+# cutoffs: minutes after the cycle time at which bufr_make_output() is run
+#   (e.g. [20, 180] for a first output and a later update)
+# poll_interval: seconds between scans if there is no inotify
+#   (with inotify, it is the maximum time between scans)
+# settle_time: seconds to wait after an event, so a burst of files is handled at once
+# the other options are as for update_sqlite()
+def gts_monitor(SQL_path, GTS_path, BUFR_path, cycle_step=1, obs_window_size=60, cutoffs=[20],
+                parse_cache=None, workers=1, filter_spec=None,
+                poll_interval=60, settle_time=2) :
+  print('========================')
+  print('= SYNOP GTS daemon     =')
+  print('========================')
+  print('Writing GTS data to ' + SQL_path)
+  print('Writing BUFR output to ' + BUFR_path)
+  ingest = ingest_setup(parse_cache, workers, filter_spec)
+  notify = inotify_open()
+  if notify is None :
+    print('No inotify: polling every %i seconds' % poll_interval)
+  cycles = {}
+  signal.signal(signal.SIGTERM, monitor_stop)
+  try :
+    while 1 :
+      now = dt.datetime.utcnow()
+      # 1. open new cycles, close the ones that are finished
+      for cycle_date in open_cycles(now, cycle_step, obs_window_size) :
+        if cycle_date not in cycles :
+          print(now.strftime('%Y%m%d %H:%M:%S') + ' opening cycle ' + cycle_date.strftime('%Y%m%d%H%M'))
+          (db, meta) = open_cycle_db(cycle_date, SQL_path, obs_window_size)
+          check_create_outputtable(db)
+          cycles[cycle_date] = (db, meta)
+      for cycle_date in list(cycles) :
+        if now > cycle_date + dt.timedelta(hours=48) :
+          print(now.strftime('%Y%m%d %H:%M:%S') + ' closing cycle ' + cycle_date.strftime('%Y%m%d%H%M'))
+          cycles.pop(cycle_date)[0].close()
+
+      # 2. ingest all new files (in 1 pass for all cycles)
+      nfiles = scan_gts_dirs_multi(cycles, GTS_path, ingest, verbose=False)
+      for cycle_date in sorted(nfiles) :
+        if nfiles[cycle_date] > 0 :
+          print(dt.datetime.utcnow().strftime('%Y%m%d %H:%M:%S') + ' cycle ' +
+                cycle_date.strftime('%Y%m%d%H%M') + ': %i new files' % nfiles[cycle_date])
+
+      # 3. BUFR output at the cutoff times (also if we missed them while not running)
+      now = dt.datetime.utcnow()
+      timeout = poll_interval
+      for cycle_date in sorted(cycles) :
+        db = cycles[cycle_date][0]
+        passed = []
+        for cutoff in sorted(cutoffs) :
+          cutoff_time = cycle_date + dt.timedelta(minutes=cutoff)
+          if now < cutoff_time :
+            timeout = min(timeout, (cutoff_time - now).total_seconds())
+          elif not output_done(db, cutoff) :
+            passed.append(cutoff)
+        # if several cutoffs were missed, only the latest output is useful
+        if len(passed) > 0 :
+          bufr_make_output(cycle_date, SQL_path, BUFR_path, workers)
+          for cutoff in passed :
+            output_mark(db, cutoff)
+
+      # 4. wait for new files
+      if notify is not None :
+        # new files arrive in the latest hourly directories
+        # new directories are created in GTS_path
+        watchlist = [ GTS_path ] + [ os.path.join(GTS_path, (now - dt.timedelta(hours=h)).strftime('%Y%m%d%H'))
+                                     for h in range(2) ]
+        inotify_set_watches(notify, watchlist)
+        if inotify_wait(notify, timeout) :
+          time.sleep(settle_time)
+      else :
+        time.sleep(timeout)
+  except (KeyboardInterrupt, SystemExit) as err :
+    print('Stopping GTS daemon: ' + str(err))
+  finally :
+    for cycle_date in cycles :
+      cycles[cycle_date][0].close()
+    ingest_close(ingest)
+    if notify is not None :
+      inotify_close(notify)
+  print('= DAEMON FINISHED =')